@@ -29,6 +29,7 @@ import base_io as io
 import queen
 import alcove
 from timestream import TimeStream
+from timestream_writer import TimeStreamWriter, TimeStreamRecorder
 import ip_addr as ip
 
 
@@ -79,10 +80,12 @@ class MainWindow(QMainWindow):
         # stop the queen listening thread
         if self.queenlisten_thread is not None:
             self.queenlisten_thread.stop()
-        
+
         # ask user for exit confirmation
         event.ignore()
         if self.confirmClose():
+            # stop the timestream acquisition thread
+            self.stopTimestream()
             event.accept()
 
 
@@ -245,15 +248,20 @@ class MainWindow(QMainWindow):
         self.canvas_timestream = FigureCanvas(self.figure_timestream)
         layout.addWidget(self.canvas_timestream)
 
-        def testPlot():
-            I, Q = np.array((
-                [np.random.normal(size=(1000)) for i in range(10)],
-                [np.random.normal(size=(1000)) for i in range(10)]))
-            kid_id = 0
-            
-            self.figure_timestream.clear()
-            self.line1, = plt.plot(I[kid_id]**2 + Q[kid_id]**2, label='power', color='tab:green')
-        testPlot()
+        # one persistent line for every mode, redrawn by blitting
+        self.plot_timestream = BlitLine(
+            self.canvas_timestream, self.axes_timestream, color='tab:green')
+
+        # all KIDs at once: a waterfall of a per KID summary of each chunk
+        self.figure_timestream_kids = plt.figure(figsize=(5, 2), dpi=100)
+        self.axes_timestream_kids = self.figure_timestream_kids.add_subplot(111)
+        self.axes_timestream_kids.set_xlabel('KID ID')
+        self.canvas_timestream_kids = FigureCanvas(self.figure_timestream_kids)
+        layout.addWidget(self.canvas_timestream_kids)
+        self.plot_timestream_kids = BlitImage(
+            self.canvas_timestream_kids, self.axes_timestream_kids)
+        self.canvas_timestream_kids.mpl_connect(
+            'button_press_event', self.onClickTimestreamKids)
 
         layout_timestreamui = QHBoxLayout()
         layout.addLayout(layout_timestreamui)
@@ -278,6 +286,10 @@ class MainWindow(QMainWindow):
         self.pulldown_timestream.addItems(['power', 'phase'])
         layout_timestreamui.addWidget(self.pulldown_timestream)
 
+        self.pulldown_timestream_kids = QComboBox()
+        self.pulldown_timestream_kids.addItems(['rms', 'phase', 'power'])
+        layout_timestreamui.addWidget(self.pulldown_timestream_kids)
+
         self.button_timestream = QPushButton("Start Time Stream")
         self.button_timestream.setCheckable(True)
         self.button_timestream.clicked.connect(self.onClickedButtonTimestream)
@@ -296,15 +308,12 @@ class MainWindow(QMainWindow):
         self.timer_timestream_save.timeout.connect(self.updateTimeStreamTimer)
         self.timestream_save_time = 0
 
-        self.timer_timestream = QTimer()
-        self.timer_timestream.timeout.connect(self.updateFigureTimestream)
-
         self.timestream = None
-        self.data_timestream = None 
-        # 3D array of format: [[I], [Q]]
-        # where I and Q have format: [[res1], [res2], [res3], ..., [resM]]
-        # and resM have format: [val1, val2, ..., valN]
-        self.data_timestream_save = None
+        self.timestream_thread = None # TimestreamThread
+        self.data_timestream = None # TimestreamBuffer of the plot window
+        self.data_timestream_kids = None # KidWaterfall of chunk summaries
+        self.timestream_recorder = None # TimeStreamRecorder of a capture to disk
+        self.timestream_save_drops0 = 0 # kernel drops when the capture started
 
 
     def onClickedButtonTimestream(self):
@@ -321,21 +330,50 @@ class MainWindow(QMainWindow):
                 # TODO: 
                 self.timestream = TimeStream(host=tIP, port=t_port)
                 # self.timestream = 'hi'
-                
-                self.timer_timestream.start(100)  # milliseconds
+
+                # capture and decode off the GUI thread
+                # (capturing already, so a disk capture can start right away)
+                self.timestream.startCapture()
+                self.timestream_thread = TimestreamThread(self, self.timestream)
+                self.timestream_thread.data.connect(self.updateFigureTimestream)
+                self.timestream_thread.start()
                 self.updateTimeStreamUI(running=True)
             except Exception as e:
-                self.timer_timestream.stop()
+                self.stopTimestream()
                 self.updateTimeStreamUI(running=False)
                 print(f"Error: Can't start timestream: {e}")
 
         else:
-            self.timestream = None
-            self.timer_timestream.stop()
+            self.stopTimestream()
             self.updateTimeStreamUI(running=False)
 
-            self.data_timestream_save = None
             self.button_timestream_save.setChecked(False)
+            self.updateTimeStreamSaveUI(running=False)
+            self.timer_timestream_save.stop()
+
+
+    def stopTimestream(self):
+        """Stop the acquisition thread and release the socket."""
+
+        self.stopTimestreamSave() # first, so it writes everything captured
+
+        if self.timestream_thread is not None:
+            self.timestream_thread.stop()
+            self.timestream_thread = None
+
+        if self.timestream is not None:
+            self.timestream.stopCapture() # if the thread never ran
+            self.timestream.sock.close()
+            self.timestream = None
+        self.data_timestream = None
+        self.data_timestream_kids = None
+
+
+    def onClickTimestreamKids(self, event):
+        """Plot the KID clicked on in the waterfall."""
+
+        if event.inaxes is self.axes_timestream_kids and event.xdata is not None:
+            self.textbox_timestream_id.setText(str(max(int(round(event.xdata)), 0)))
 
 
     def updateTimeStreamUI(self, running):
@@ -358,30 +396,73 @@ class MainWindow(QMainWindow):
     def onClickedButtonTimestreamSave(self):
         if self.button_timestream_save.isChecked():
             # assuming can only click if timestream running
-            # isChecked used in updateFigureTimestream()
-            self.updateTimeStreamSaveUI(running=True)
             self.timestream_save_time = 0
+            try:
+                self.startTimestreamSave()
+            except Exception as e:
+                self.button_timestream_save.setChecked(False)
+                print(f"Error: Can't start capture: {e}")
+                return
+            self.updateTimeStreamSaveUI(running=True)
             self.timer_timestream_save.start(1000) # 1 s
 
         else:
-            self.saveToFileTimestreamSave()
+            self.stopTimestreamSave()
             self.updateTimeStreamSaveUI(running=False)
             self.timer_timestream_save.stop()
             self.timestream_save_time = 0
 
 
-    def saveToFileTimestreamSave(self):
-        base_fname = f'timestream_{self.textbox_timestream_ip.text()}_'
-        fname = io.saveToTmp(self.data_timestream_save, 
-                             filename=base_fname, use_timestamp=True)
-        print(f"Saving captured timestream to file: {fname}")
-        self.data_timestream_save = None
+    def startTimestreamSave(self):
+        """Stream the captured packets to disk from a background thread.
+        The packets are written chunk by chunk as they arrive
+        (see TimeStreamWriter), so memory use stays flat.
+        """
+
+        if self.timestream is None or not self.timestream.capturing():
+            raise RuntimeError("Timestream isn't capturing yet.")
+
+        base_fname = f'timestream_{self.textbox_timestream_ip.text()}'
+        writer = TimeStreamWriter(dname='tmp', fname=base_fname)
+        self.timestream_save_drops0 = self.timestream.sock_stats.rxq_ovfl
+        self.timestream_recorder = TimeStreamRecorder(self.timestream, writer)
+        self.timestream_recorder.start()
+
+
+    def stopTimestreamSave(self):
+        """Stop the capture to disk, writing what is left."""
+
+        if self.timestream_recorder is None:
+            return
+
+        self.timestream_recorder.stop()
+        files = self.timestream_recorder.writer.files
+        self.timestream_recorder = None
+        print(f"Saved captured timestream to file(s): {', '.join(files)}")
+
+
+    def timestreamSaveStatus(self):
+        """Capture to disk progress: elapsed time, bytes, and drops.
+        Drops are packets lost in the kernel socket buffer plus packets
+        overwritten in the capture ring before they were written.
+        """
+
+        rec = self.timestream_recorder
+        if rec is None:
+            return ""
+
+        drops = rec.skipped
+        if self.timestream is not None:
+            drops += self.timestream.sock_stats.rxq_ovfl - self.timestream_save_drops0
+        mb = rec.writer.bytes_written/2**20
+
+        return f"{self.timestream_save_time} s, {mb:.1f} MB, {drops} dropped"
 
 
     def updateTimeStreamSaveUI(self, running):
         if running:
             self.button_timestream_save.setText("Save Capture")
-            self.label_timestream_save.setText(f"{self.timestream_save_time}")
+            self.label_timestream_save.setText(self.timestreamSaveStatus())
 
         else:
             self.button_timestream_save.setText("Start Capture")
@@ -390,10 +471,22 @@ class MainWindow(QMainWindow):
         
     def updateTimeStreamTimer(self):
         self.timestream_save_time += 1
-        self.label_timestream_save.setText(f"{self.timestream_save_time}")
+        self.label_timestream_save.setText(self.timestreamSaveStatus())
 
 
-    def updateFigureTimestream(self):
+    def updateFigureTimestream(self, data):
+        """Add a decoded chunk from the TimestreamThread and replot.
+        data: (tuple) t, I, and Q of the packets since the last chunk.
+        """
+
+        try:
+            self._updateFigureTimestream(data)
+        finally:
+            if self.timestream_thread is not None:
+                self.timestream_thread.ready() # send the next chunk
+
+
+    def _updateFigureTimestream(self, data):
         if self.timestream is None:
             return
 
@@ -414,51 +507,46 @@ class MainWindow(QMainWindow):
         #     drid = 1
         # self.textbox_timestream_bid_drid.setText(str(f'{bid}.{drid}')) # update GUI
 
-        # grab a chunk of timestream, hardcoded 100 packets
-        # TODO:
-        I, Q = _getTimestreamData(self.timestream, 100, kid_id)
+        # chunk of timestream from the acquisition thread
+        t, I, Q = data
         # I, Q = np.array((
         #     [np.random.normal(size=(1000)) for i in range(10)],
         #     [np.random.normal(size=(1000)) for i in range(10)]))
 
-        # add new data to capture data
-        if self.button_timestream_save.isChecked():
-            if self.data_timestream_save is None:
-                self.data_timestream_save = np.array([I, Q])
-            else:
-                I_save = np.concatenate((self.data_timestream_save[0], I), axis=1)
-                Q_save = np.concatenate((self.data_timestream_save[1], Q), axis=1)
-                self.data_timestream_save = np.array([I_save, Q_save])
-
-
-        # add new data to already collected data 
-        if self.data_timestream is not None: # None if first loop
-            I = np.concatenate((self.data_timestream[0], I), axis=1)
-            Q = np.concatenate((self.data_timestream[1], Q), axis=1)
-
-        # crop to desired data length (# of packets)
+        # desired data length (# of packets)
         try: 
             ts_win = max(int(self.textbox_timestream_win.text()), 2)
         except:
             ts_win = 1000 # default ts_win length (# of packets)
-        I = I[:,-ts_win:] # crop each res stream to ts_win packets
-        Q = Q[:,-ts_win:]
-
-        # save to instance variable for next loop
-        self.data_timestream = np.array([I, Q])
 
-        # if len(I[kid_id]**2 + Q[kid_id]**2) == 1000:
-        
-        # plot in timestream figure00
-        # self.figure_timestream.clear() # clear figure and replot
-        if self.pulldown_timestream.currentText() == 'power':
-            # plt.plot(I[kid_id]**2 + Q[kid_id]**2, 
-                    #  label='power', color='tab:green')
-            self.line1.set_ydata(I[kid_id]**2 + Q[kid_id]**2)
+        # one summary value per KID of the whole chunk, as a waterfall row
+        kids_mode = self.pulldown_timestream_kids.currentText()
+        kids = self.data_timestream_kids
+        if kids is None or kids.n_channels != I.shape[0] or kids.mode != kids_mode:
+            kids = self.data_timestream_kids = KidWaterfall(I.shape[0], kids_mode)
+        kids.add(_kidSummary(I, Q, kids_mode))
+        self.plot_timestream_kids.update(kids.data, ylabel=f'{kids_mode} (chunks)')
+
+        # add new data to the window buffer, in place
+        # a new buffer is only made when the window length changes
+        buf = self.data_timestream
+        if buf is None or buf.n_channels != I.shape[0]:
+            buf = self.data_timestream = TimestreamBuffer(I.shape[0], ts_win)
+        elif buf.length != ts_win:
+            buf.resize(ts_win)
+        buf.append(t, I, Q)
+
+        # the plotted KID in time order
+        kid_id = min(kid_id, buf.n_channels - 1)
+        _, I, Q = buf.channel(kid_id)
+
+        # plot in timestream figure
+        mode = self.pulldown_timestream.currentText()
+        if mode == 'power':
+            y = I**2 + Q**2
         else:
-            plt.plot(np.arctan2(Q[kid_id], I[kid_id]), 
-                    label='phase', color='tab:green')
-        self.canvas_timestream.draw()
+            y = np.arctan2(Q, I)
+        self.plot_timestream.update(y, xmax=ts_win, ylabel=mode)
 
 
 
@@ -689,6 +777,61 @@ class AlcoveCommandThread(QThread):
         self.finished.emit((ret, self.com_str, self.com_to, self.com_args))
 '''
 
+class TimestreamThread(QThread):
+    """Timestream acquisition and decoding off the GUI thread.
+
+    The TimeStream captures in its own background thread, so no packet
+    waits on the GUI. Every interval this thread decodes the packets
+    captured since the last chunk and emits them as (t, I, Q) on data.
+    Until the GUI calls ready() the packets keep collecting in the ring
+    (about 16 s of it) and go out together in the next chunk, so a slow
+    redraw neither loses data nor queues up signals.
+    """
+
+    data = pyqtSignal(object)
+
+    def __init__(self, parent, timestream, interval=100):
+        """
+        timestream: (TimeStream) Bound timestream to capture from.
+        interval:   (int) Milliseconds between chunks.
+        """
+
+        QThread.__init__(self, parent)
+        self.timestream = timestream
+        self.interval = interval
+        self._running = True # before start(), so an early stop() sticks
+        self._waiting = False # GUI still busy with the last chunk
+
+
+    def run(self):
+        self.timestream.startCapture() # no-op if the caller started it
+        cursor = None # only packets from now on
+
+        while self._running:
+            self.msleep(self.interval)
+            if self._waiting:
+                continue
+
+            cursor, t, I, Q = self.timestream.getSince(
+                cursor, return_time=True, dtype=np.float32)
+            if len(t):
+                self._waiting = True
+                self.data.emit((t, I, Q))
+
+        self.timestream.stopCapture()
+
+
+    def ready(self):
+        """The GUI is done with the last chunk."""
+
+        self._waiting = False
+
+
+    def stop(self):
+        self._running = False
+        self.wait()
+
+
 # WorkerSignals and Worker are from:
 # https://www.pythonguis.com/tutorials/multithreading-pyside6-applications-qthreadpool/
 class WorkerSignals(QObject):
@@ -751,6 +894,261 @@ class Worker(QRunnable):
 
 
 
+# ============================================================================ #
+# Display Buffers
+# ============================================================================ #
+
+
+class TimestreamBuffer:
+    """Fixed size circular buffer of the last length samples of every channel.
+
+    New chunks overwrite the oldest samples in place, so adding one costs
+    only the size of the chunk. Readers get a channel in time order
+    (a rolled copy of just that channel).
+    """
+
+    def __init__(self, n_channels, length, dtype=np.float32):
+        """
+        n_channels: (int) Channels (rows) of the chunks.
+        length:     (int) Samples kept per channel (the window length).
+        dtype:      (numpy dtype) I and Q type.
+        """
+
+        self.n_channels = n_channels
+        self.dtype = dtype
+        self._alloc(length)
+
+
+    def _alloc(self, length):
+        self.length = int(length)
+        self.t = np.zeros(self.length, dtype=np.int64)
+        self.I = np.zeros((self.n_channels, self.length), dtype=self.dtype)
+        self.Q = np.zeros((self.n_channels, self.length), dtype=self.dtype)
+        self.head = 0 # column the next sample goes in
+        self.n = 0    # samples held
+
+
+    def resize(self, length):
+        """Change the window length, keeping the newest samples."""
+
+        t, I, Q = self.ordered(min(self.n, length))
+        self._alloc(length)
+        self.append(t, I, Q)
+
+
+    def append(self, t, I, Q):
+        """Overwrite the oldest samples with a chunk.
+        t:    (1D array) Sample times.
+        I, Q: (2D arrays) Shape (n_channels, N).
+        """
+
+        N = len(t)
+        if N >= self.length: # only the end of the chunk fits
+            t, I, Q = t[-self.length:], I[:, -self.length:], Q[:, -self.length:]
+            N = self.length
+
+        i0 = self.head
+        n1 = min(N, self.length - i0) # up to the end of the buffer
+        for a, x in ((self.t, t), (self.I, I), (self.Q, Q)):
+            a[..., i0:i0 + n1] = x[..., :n1]
+            a[..., :N - n1] = x[..., n1:] # wrapped part
+
+        self.head = (i0 + N) % self.length
+        self.n = min(self.n + N, self.length)
+
+
+    def _order(self, n):
+        """Columns of the newest n samples, oldest first."""
+
+        return (self.head - n + np.arange(n)) % self.length
+
+
+    def channel(self, kid_id):
+        """t, I, and Q of one channel in time order."""
+
+        cols = self._order(self.n)
+        return self.t[cols], self.I[kid_id, cols], self.Q[kid_id, cols]
+
+
+    def ordered(self, n=None):
+        """t, I, and Q of every channel in time order (a copy),
+        the newest n samples (default all held).
+        """
+
+        cols = self._order(self.n if n is None else n)
+        return self.t[cols], self.I[:, cols], self.Q[:, cols]
+
+
+
+class KidWaterfall:
+    """The last rows per KID summaries (one per chunk) of every channel.
+    Rows scroll up in place, newest last, and are NaN until filled
+    (so the image keeps its shape and can be blitted).
+    """
+
+    def __init__(self, n_channels, mode, rows=100):
+        """
+        n_channels: (int) Channels (KIDs) per row.
+        mode:       (str) Summary the rows are, see _kidSummary().
+        rows:       (int) Rows kept.
+        """
+
+        self.n_channels = n_channels
+        self.mode = mode
+        self.data = np.full((rows, n_channels), np.nan, dtype=np.float32)
+        self.n = 0 # rows held
+
+
+    def add(self, row):
+        self.data[:-1] = self.data[1:]
+        self.data[-1] = row
+        self.n = min(self.n + 1, len(self.data))
+
+
+
+# ============================================================================ #
+# Fast Plotting
+# ============================================================================ #
+
+
+class _Blit:
+    """A persistent animated artist redrawn by blitting.
+
+    The figure is only fully drawn when the axes change (or Qt redraws
+    it, e.g. on resize), which caches the background. Every other update
+    restores that background and draws just the artist.
+    """
+
+    def __init__(self, canvas, ax, artist):
+        self.canvas = canvas
+        self.ax = ax
+        self.artist = artist
+        self._background = None
+        canvas.mpl_connect('draw_event', self._onDraw)
+
+
+    def _onDraw(self, event):
+        """Cache the freshly drawn background (everything but the artist)."""
+
+        self._background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.ax.draw_artist(self.artist)
+
+
+    def _setYlabel(self, ylabel):
+        """Return: (bool) Whether the label changed."""
+
+        if ylabel is None or ylabel == self.ax.get_ylabel():
+            return False
+        self.ax.set_ylabel(ylabel)
+        return True
+
+
+    def _draw(self, redraw):
+        if redraw or self._background is None:
+            self.canvas.draw() # recaches the background
+        else:
+            self.canvas.restore_region(self._background)
+            self.ax.draw_artist(self.artist)
+            self.canvas.blit(self.ax.bbox)
+
+
+class BlitLine(_Blit):
+    """A blitted line of sample index against value.
+    Data longer than the axes is min/max decimated to its pixel width,
+    so the cost per update doesn't grow with the window length.
+    """
+
+    def __init__(self, canvas, ax, **kwargs):
+        """
+        canvas: (FigureCanvas) Canvas the axes are drawn on.
+        ax:     (Axes) Axes to plot in.
+        kwargs: Passed to ax.plot(), e.g. color.
+        """
+
+        self.line, = ax.plot([], [], animated=True, **kwargs)
+        super().__init__(canvas, ax, self.line)
+
+
+    def update(self, y, xmax=None, ylabel=None):
+        """Plot y against sample index.
+        y:      (1D array) Data.
+        xmax:   (int) x axis length (default len(y)), e.g. the window
+            length so the axis is stable while the window fills.
+        ylabel: (str) y axis label.
+        """
+
+        n = len(y)
+        x = np.arange(n)
+        width = max(int(self.ax.bbox.width), 1) # pixels
+        x, y = _minMaxDecimate(x, y, width)
+        self.line.set_data(x, y)
+
+        redraw = self._limits(y, xmax or n)
+        redraw |= self._setYlabel(ylabel)
+        self._draw(redraw)
+
+
+    def _limits(self, y, xmax):
+        """Rescale the axes if the data left them or shrank a lot.
+        Return: (bool) Whether the limits changed.
+        """
+
+        changed = False
+        if self.ax.get_xlim() != (0, xmax - 1):
+            self.ax.set_xlim(0, max(xmax - 1, 1))
+            changed = True
+
+        finite = y[np.isfinite(y)]
+        if len(finite) == 0:
+            return changed
+        lo, hi = finite.min(), finite.max()
+        y0, y1 = self.ax.get_ylim()
+        if lo < y0 or hi > y1 or (hi - lo) < 0.25*(y1 - y0):
+            pad = 0.1*(hi - lo) or 0.1*abs(hi) or 1
+            self.ax.set_ylim(lo - pad, hi + pad)
+            changed = True
+
+        return changed
+
+
+class BlitImage(_Blit):
+    """A blitted image, one update for a whole 2D array.
+    The colour scale follows the 1st to 99th percentile of the data.
+    """
+
+    def __init__(self, canvas, ax, **kwargs):
+        """
+        canvas: (FigureCanvas) Canvas the axes are drawn on.
+        ax:     (Axes) Axes to plot in.
+        kwargs: Passed to ax.imshow(), e.g. cmap.
+        """
+
+        self.image = ax.imshow(np.full((1, 1), np.nan), aspect='auto',
+            origin='lower', interpolation='nearest', animated=True, **kwargs)
+        super().__init__(canvas, ax, self.image)
+
+
+    def update(self, data, ylabel=None):
+        """Show data (rows, columns), first row at the bottom.
+        ylabel: (str) y axis label.
+        """
+
+        redraw = data.shape != self.image.get_array().shape
+        self.image.set_data(data)
+        if redraw:
+            rows, cols = data.shape
+            self.image.set_extent((-0.5, cols - 0.5, -0.5, rows - 0.5))
+
+        finite = data[np.isfinite(data)]
+        if len(finite):
+            lo, hi = np.percentile(finite, (1, 99))
+            self.image.set_clim(lo, hi if hi > lo else lo + 1)
+
+        redraw |= self._setYlabel(ylabel)
+        self._draw(redraw)
+
+
+
 # ============================================================================ #
 # INTERNAL FUNCTIONS
 # ============================================================================ #
@@ -766,6 +1164,53 @@ class ConsoleEmitter(QObject):
     write = sys.stdout.write # hold connection console
 
 
+# ============================================================================ #
+# Time Stream
+
+def _minMaxDecimate(x, y, n_bins):
+    """Decimate a line to its min and max in each of n_bins bins.
+    Keeps every spike visible at a fraction of the points.
+
+    x, y:   (1D arrays) Line data.
+    n_bins: (int) Bins, e.g. the axes width in pixels.
+
+    Return: x and y with 2 points per bin (or unchanged if already short).
+    """
+
+    n = len(y)
+    if n <= 2*n_bins:
+        return x, y
+
+    edges = np.linspace(0, n, n_bins + 1).astype(int)[:-1]
+    out_x = np.repeat(x[edges], 2)
+    out_y = np.empty(2*len(edges), dtype=y.dtype)
+    out_y[0::2] = np.minimum.reduceat(y, edges)
+    out_y[1::2] = np.maximum.reduceat(y, edges)
+
+    return out_x, out_y
+
+
+def _kidSummary(I, Q, mode):
+    """One value per channel of a chunk, all channels at once.
+
+    I, Q: (2D arrays) Chunk of shape (channels, N).
+    mode: (str) {'rms', 'phase', 'power'}
+        rms:   RMS about the mean of I and Q, the chunk noise.
+        phase: Mean phase [rad] (angle of the mean I + jQ).
+        power: Mean I**2 + Q**2.
+
+    Return: (1D array) Shape (channels,).
+    """
+
+    if mode == 'rms':
+        return np.sqrt(np.var(I, axis=1) + np.var(Q, axis=1))
+    if mode == 'phase':
+        return np.arctan2(np.mean(Q, axis=1), np.mean(I, axis=1))
+    if mode == 'power':
+        return np.mean(I**2 + Q**2, axis=1)
+    raise ValueError(f"Unknown KID summary: {mode}")
+
+
 # ============================================================================ #
 # Alcove/Queen Commands
 
@@ -808,27 +1253,6 @@ def _sendQueenCommand(com_str, com_args, progress_callback):
     return queen.callCom(com_num, com_args)
 
 
-# ============================================================================ #
-# Time Stream
-
-def _getTimestreamData(timestream, packets=100, kid_id=None):
-    """Get a chunk of time stream data.
-    timestream: (TimeStream) the timestream object.
-    packets: (int) number of packets to capture.
-    kid_id:  (int) ID of resonator. If None get all.
-    """
-
-    I, Q = timestream.getTimeStreamChunk(packets)
-
-    # # fake data for testing
-    # X = 10 # number of kids
-    # N = packets # number of packets
-    # I = np.random.rand(X, N)
-    # Q = np.random.rand(X, N)
-
-    return I, Q
-
-
 # ============================================================================ #
 # File System
 
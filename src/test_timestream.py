@@ -0,0 +1,321 @@
+# ============================================================================ #
+# test_timestream.py
+# Synthetic packet and loopback tests of timestream capture and storage.
+# Run with: python -m pytest src/test_timestream.py
+# James Burgoyne jburgoyne@phas.ubc.ca
+# CCAT Prime 2024
+# ============================================================================ #
+
+
+
+# ============================================================================ #
+# IMPORTS & GLOBALS
+# ============================================================================ #
+
+
+import os
+import socket
+import threading
+import time
+import multiprocessing as mp
+import numpy as np
+import pytest
+
+from timestream import (
+    TimeStream, MultiTimeStream, PacketStats, N_CHANNELS, PACKET_BYTES,
+    decodeChunk)
+from timestream_dsp import Decimator
+from timestream_merge import StreamMerger
+from timestream_shm import SharedPacketRing, SharedTimeStream
+from timestream_sim import makePackets, PacketGenerator
+from timestream_writer import (
+    TimeStreamWriter, TimeStreamArchiveWriter, TimeStreamArchive,
+    loadTimestreamFiles)
+
+
+T0 = 1_700_000_000_000_000_000 # PTP time of the first packet [ns]
+DT = 2_000_000 # packet period [ns]
+
+
+
+# ============================================================================ #
+# helpers
+
+def packets(count0, n, sign=1):
+    """n packets from count count0, with I = sign*(count + channel)
+    and Q = -I in every channel."""
+
+    c = count0 + np.arange(n)
+    I = sign*(c[None, :] + np.arange(N_CHANNELS)[:, None]).astype(np.int32)
+    return makePackets(c, T0 + DT*c, I, -I)
+
+
+def sendFrom(src_ip, port, pkts):
+    """Send packets to loopback port from src_ip."""
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((src_ip, 0))
+    for p in pkts:
+        sock.sendto(p, ('127.0.0.1', port))
+    sock.close()
+
+
+
+# ============================================================================ #
+# packets
+
+def test_decodeChunk_roundtrip():
+    x = packets(7, 20)
+
+    t, I, Q = decodeChunk(x, return_time=True)
+    assert np.array_equal(t, T0 + DT*np.arange(7, 27))
+    assert I.shape == (N_CHANNELS, 20)
+    assert np.array_equal(I, np.arange(7, 27)[None, :] + np.arange(N_CHANNELS)[:, None])
+    assert np.array_equal(Q, -I)
+
+
+def test_decodeChunk_dtypes_and_channels():
+    x = packets(0, 10)
+
+    I, Q = decodeChunk(x, dtype=np.float32, channels=[3, 500])
+    assert I.dtype == np.float32 and I.shape == (2, 10)
+    assert np.array_equal(I[1], 500 + np.arange(10))
+
+    I, Q = decodeChunk(x, dtype=None)
+    assert I.dtype == np.int32
+    assert np.array_equal(I[0], np.arange(10))
+
+
+def test_PacketStats_gap_wrap_reorder():
+    st = PacketStats()
+    st.update([2**32 - 2, 2**32 - 1, 0, 1])
+    assert (st.wraps, st.lost, st.gaps) == (1, 0, 0)
+
+    st = PacketStats()
+    st.update([0, 1, 5])
+    assert (st.lost, st.gaps) == (3, 1)
+
+    st = PacketStats()
+    st.update([0, 1, 3, 2, 4])
+    assert (st.lost, st.out_of_order, st.duplicates) == (0, 1, 0)
+
+    st = PacketStats()
+    st.update([0, 1])
+    st.update([1, 2])
+    assert (st.duplicates, st.received) == (1, 4)
+
+    # a stale duplicate fills no gap
+    st = PacketStats()
+    st.update([0, 1, 2, 3])
+    st.update([1])
+    assert (st.lost, st.out_of_order, st.duplicates) == (0, 0, 1)
+
+    # only the first late copy fills the gap
+    st = PacketStats()
+    st.update([0, 3, 1, 1, 2])
+    assert (st.lost, st.out_of_order, st.duplicates) == (0, 2, 1)
+
+    # a counter reset is not hundreds of late packets
+    st = PacketStats()
+    st.update(np.arange(1000))
+    st.update(np.arange(500))
+    assert (st.lost, st.out_of_order, st.resets, st.received) == (0, 0, 1, 1500)
+    st.update([502])
+    assert (st.lost, st.gaps) == (2, 1)
+
+
+
+# ============================================================================ #
+# capture
+
+def test_TimeStream_chunk_larger_than_ring():
+    ts = TimeStream('127.0.0.1', 0)
+    ts.sock.settimeout(5)
+    port = ts.sock.getsockname()[1]
+
+    gen = PacketGenerator(port=port, rate=2000, count0=100)
+    sender = threading.Thread(target=gen.send, args=(4 + 300,))
+    sender.start()
+    try:
+        ts.getTimeStreamChunk(4)
+        I, Q = ts.getTimeStreamChunk(300) # more than the first ring held
+    finally:
+        sender.join()
+        gen.close()
+        ts.sock.close()
+
+    assert I.shape == (N_CHANNELS, 300)
+    st = ts.stats['127.0.0.1']
+    assert (st.received, st.lost) == (304, 0)
+
+
+def test_MultiTimeStream_two_sources():
+    m = MultiTimeStream([('127.0.0.1', 0)], ring_size=4)
+    port = m.socks[0].getsockname()[1]
+    try:
+        for c0 in (0, 3): # a wrapped ring, every packet accounted
+            sendFrom('127.0.0.1', port, packets(c0, 3))
+            time.sleep(0.05)
+            m.poll(1)
+        sendFrom('127.0.0.2', port, packets(0, 3, sign=-1))
+        time.sleep(0.05)
+        m.poll(1)
+
+        # source B must not land on the wrapped ring of source A
+        I, _ = m.getLatest('127.0.0.1', 4)
+        assert np.array_equal(I[0], np.arange(2, 6))
+        I, _ = m.getLatest('127.0.0.2', 3)
+        assert np.array_equal(I[0], -np.arange(3))
+        assert m.stats['127.0.0.1'].received == 6
+        assert m.stats['127.0.0.2'].received == 3
+    finally:
+        m.close()
+
+
+
+def test_getLatest_fewer_than_captured():
+    ts = TimeStream('127.0.0.1', 0, ring_size=100)
+    port = ts.sock.getsockname()[1]
+    try:
+        ts.startCapture()
+        sendFrom('127.0.0.1', port, packets(0, 10))
+        t_end = time.monotonic() + 5
+        while ts.ring.count < 10 and time.monotonic() < t_end:
+            time.sleep(0.01)
+
+        t, I, _ = ts.getLatest(15, return_time=True) # never filled rows excluded
+        assert np.array_equal(t, T0 + DT*np.arange(10))
+        assert np.array_equal(I[0], np.arange(10))
+    finally:
+        ts.stopCapture()
+        ts.sock.close()
+
+
+
+# ============================================================================ #
+# shared memory
+
+def _sharedReader(name, seconds, result):
+    """Read a SharedPacketRing as fast as possible in another process.
+    Puts the number of reads and of errors on result."""
+
+    ts = SharedTimeStream(name)
+    reads = errors = 0
+    t_end = time.monotonic() + seconds
+    while time.monotonic() < t_end:
+        try:
+            ts.getRawSince(0)
+            I, _ = ts.getLatest(64)
+            assert I.shape[1] <= 64
+            reads += 1
+        except ValueError:
+            errors += 1
+    ts.close()
+    result.put((reads, errors))
+
+
+def test_SharedPacketRing_reader_racing_writer():
+    ring = SharedPacketRing(f'test_timestream_{os.getpid()}', 64, create=True)
+    pkts = packets(0, 64)
+    result = mp.Queue()
+    reader = mp.Process(target=_sharedReader, args=(ring.name, 1, result))
+    reader.start()
+
+    # write flat out until the reader is done, lapping it constantly
+    try:
+        i = 0
+        while reader.is_alive():
+            ring.nextSlot()[:] = pkts[i % 64]
+            ring.commit(PACKET_BYTES)
+            i += 1
+        reads, errors = result.get(timeout=5)
+    finally:
+        reader.join()
+        ring.close()
+
+    assert reads > 0 and errors == 0
+
+
+def test_SharedTimeStream_getLatest_fewer_than_published():
+    ring = SharedPacketRing(f'test_timestream_{os.getpid()}', 100, create=True)
+    try:
+        for p in packets(0, 10):
+            ring.nextSlot()[:] = p
+            ring.commit(PACKET_BYTES)
+        ring.nextSlot() # a row being written
+
+        ts = SharedTimeStream(ring.name)
+        t, I, _ = ts.getLatest(15, return_time=True)
+        ts.close()
+    finally:
+        ring.close()
+
+    assert np.array_equal(t, T0 + DT*np.arange(10))
+
+
+
+# ============================================================================ #
+# merging
+
+def test_StreamMerger_overrun_counts_every_packet():
+    m = StreamMerger(['a'], key='count', depth=8, n_channels=2)
+    I = np.zeros((2, 5))
+    m.push('a', np.arange(5), I, I, np.arange(5))
+    I = np.zeros((2, 15))
+    m.push('a', np.arange(15), I, I, np.arange(5, 20)) # spans more than depth
+
+    frames = m.pop(flush=True)
+    assert m.overrun + int(frames['valid'].sum()) == 20
+    assert np.array_equal(frames['slot'], np.arange(12, 20))
+
+
+
+# ============================================================================ #
+# storage
+
+def test_TimeStreamWriter_roundtrip(tmp_path):
+    with TimeStreamWriter(tmp_path, chunk_frames=16, file_frames=50) as w:
+        w.write(packets(0, 40))
+        w.write(packets(40, 70))
+
+    frames = np.concatenate(loadTimestreamFiles(tmp_path))
+    assert len(frames) == 110 and len(w.files) == 3
+    assert np.array_equal(frames['packet_count'], np.arange(110))
+    assert np.array_equal(frames['iq'][:, 9, 0], np.arange(110) + 9)
+
+
+def test_TimeStreamArchive_roundtrip_with_flush(tmp_path):
+    d = tmp_path/'archive'
+    with TimeStreamArchiveWriter(d, block_frames=64) as w:
+        w.write(packets(0, 10))
+        w.flush() # part full block
+        w.write(packets(10, 190))
+
+    a = TimeStreamArchive(d)
+    assert a.n_frames == 200
+
+    t, I, Q = a.readChannel(0)
+    assert np.array_equal(I, np.arange(200))
+    assert np.array_equal(Q, -np.arange(200))
+    assert np.array_equal(t, T0 + DT*np.arange(200))
+
+    t, I, _ = a.readChannel(7, T0 + DT*15, T0 + DT*100)
+    assert np.array_equal(I, np.arange(15, 100) + 7)
+
+
+
+# ============================================================================ #
+# dsp
+
+@pytest.mark.parametrize('mode', ['boxcar', 'cic', 'fir'])
+def test_Decimator_chunking_invariant(mode):
+    rng = np.random.default_rng(0)
+    x = rng.standard_normal((3, 1000))
+
+    whole = Decimator(8, mode).process(x)
+
+    dec = Decimator(8, mode)
+    edges = [0, 1, 13, 200, 207, 640, 1000]
+    parts = [dec.process(x[:, a:b]) for a, b in zip(edges[:-1], edges[1:])]
+
+    assert np.allclose(np.concatenate(parts, axis=1), whole)
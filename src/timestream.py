@@ -10,20 +10,679 @@
 ###############
 ### IMPORTS ###
 
+import os
+import sys
+import collections
 import socket
+import selectors
+import threading
+import time
 import numpy as np
 
 
 
+#######################
+### PACKET GEOMETRY ###
+
+# see docs/rfsoc_datagram.csv
+# the socket only sees the UDP payload, i.e. the datagram
+# without the 42 bytes of ethernet, IP, and UDP headers
+PACKET_HEADER_BYTES = 42
+PACKET_BYTES        = 8254 - PACKET_HEADER_BYTES # UDP payload size
+
+RING_CHUNKS = 64 # default ring size in units of the requested chunk (up to RING_SIZE)
+RING_SIZE   = 8192 # default ring size of capture rings (~67 MB)
+MULTI_RING_SIZE = 2048 # default per source ring size of MultiTimeStream (~17 MB)
+
+STATS_BATCH = 64 # background capture updates packet stats this often
+REORDER_WINDOW = 256 # packets a late packet can trail the newest by,
+                     # a larger step back is a packet counter reset
+
+# kernel receive buffer target, about 2 s of one drone at 500 packets/s
+# (the kernel counts its own overhead against this, roughly doubling
+# the bytes each packet takes)
+RCVBUF_BYTES = 16*2**20
+SOCKET_SAMPLE_S = 1 # /proc/net/udp sampling period [s]
+
+INFO_EVENTS_MAX = 4096 # packet info change events kept per source
+
+# Linux socket options that older Python builds don't name
+SO_RCVBUFFORCE = getattr(socket, 'SO_RCVBUFFORCE', 33)
+SO_RXQ_OVFL    = getattr(socket, 'SO_RXQ_OVFL', 40)
+
+N_CHANNELS = 1022 # channels with both I and Q in a packet
+
+# payload byte offsets of the packet fields
+# (datagram offsets of docs/rfsoc_datagram.csv minus PACKET_HEADER_BYTES)
+OFFSET_IQ           = 0    # channel n I at 8n, Q at 8n+4, little endian
+OFFSET_I_1022       = 8176 # lone I of channel 1022, little endian
+OFFSET_PACKET_INFO  = 8192 # low 32 bits of the big endian packet info field
+OFFSET_PACKET_COUNT = 8196 # big endian
+OFFSET_PTP          = 8200 # 96 bit big endian PTP time of day
+
+# one packet as a numpy structured dtype
+# the 96 bit PTP time of day is 48 bit seconds, 32 bit nanoseconds,
+# and 16 bit fractional nanoseconds, split into numpy sized fields
+PACKET_DTYPE = np.dtype({
+    'names':   ['iq', 'i_1022', 'packet_info', 'packet_count',
+                'ptp_sec_hi', 'ptp_sec_lo', 'ptp_ns', 'ptp_frac_ns'],
+    'formats': [('<i4', (N_CHANNELS, 2)), '<i4', '>u4', '>u4',
+                '>u2', '>u4', '>u4', '>u2'],
+    'offsets': [OFFSET_IQ, OFFSET_I_1022, OFFSET_PACKET_INFO,
+                OFFSET_PACKET_COUNT, OFFSET_PTP, OFFSET_PTP + 2,
+                OFFSET_PTP + 6, OFFSET_PTP + 10],
+    'itemsize': PACKET_BYTES})
+
+# one change of the packet info field, see PacketInfoTracker
+INFO_EVENT_DTYPE = np.dtype([
+    ('packet_count', '<u4'),
+    ('t',            '<i8'), # PTP time [ns]
+    ('value',        '<u4')])
+
+# one decoded packet (frame): native endian, PTP time in nanoseconds
+FRAME_DTYPE = np.dtype([
+    ('t',            '<i8'),
+    ('packet_count', '<u4'),
+    ('packet_info',  '<u4'),
+    ('iq',           '<i4', (N_CHANNELS, 2))])
+
+
+
+#######################
+### PACKET DECODING ###
+
+def decodePackets(packets):
+    """Decode raw packets as PACKET_DTYPE records without copying.
+
+    packets: (2D array of uint8) Raw packets, shape (N, PACKET_BYTES),
+        e.g. a PacketRing view.
+
+    Return: (1D structured array) N records viewing the same memory.
+    """
+
+    packets = np.ascontiguousarray(packets) # no-op for ring views
+    if packets.ndim != 2 or packets.shape[1] != PACKET_BYTES:
+        raise ValueError(
+            f"Expected packets of shape (N, {PACKET_BYTES}), got {packets.shape}.")
+
+    return packets.view(PACKET_DTYPE)[:, 0]
+
+
+def unpackIQ(records, channels=None, dtype=None):
+    """I and Q of each channel from decoded packet records.
+
+    records:  (1D structured array) PACKET_DTYPE records, see decodePackets().
+    channels: (int, slice, list of ints, or bool mask) Only unpack
+        these channels, straight from the packet memory.
+        None for all N_CHANNELS.
+    dtype:    (numpy dtype) Cast to this type, or None to return
+        the raw int32 values (views into the records if channels
+        is None or a slice).
+
+    Return: I and Q, each of shape (channels, N),
+        C contiguous (one row per channel) when cast.
+    """
+
+    iq = records['iq'] # (N, N_CHANNELS, 2) int32 view
+    if channels is not None:
+        if np.ndim(channels) == 0 and not isinstance(channels, slice):
+            channels = [channels]
+        iq = iq[:, channels] # only the requested columns are touched
+    I, Q = iq[:, :, 0].T, iq[:, :, 1].T
+
+    if dtype is not None:
+        I, Q = I.astype(dtype, order='C'), Q.astype(dtype, order='C')
+
+    return I, Q
+
+
+def ptpToNs(records):
+    """PTP time of day of decoded packet records in integer nanoseconds.
+    The fractional nanoseconds are dropped.
+
+    records: (1D structured array) PACKET_DTYPE records, see decodePackets().
+
+    Return: (1D array of int64) Nanoseconds since the PTP epoch.
+    """
+
+    sec = records['ptp_sec_hi'].astype(np.int64) << 32
+    sec |= records['ptp_sec_lo']
+    return sec*1_000_000_000 + records['ptp_ns']
+
+
+def userByte(info, drid):
+    """The user byte of drone drid (1-4) in packet info values,
+    as written by alcove_base.userPacket().
+
+    info: (int or array of uint32) Packet info field(s), e.g. records['packet_info'].
+
+    Return: (uint8 or array of uint8) The byte(s).
+    """
+
+    return ((np.asarray(info, dtype=np.uint32) >> (8*(drid - 1))) & 0xFF).astype(np.uint8)
+
+
+def packetsToFrames(packets, out=None):
+    """Decode raw packets into FRAME_DTYPE frames.
+
+    packets: (2D array of uint8) Raw packets, shape (N, PACKET_BYTES).
+    out:     (1D structured array) FRAME_DTYPE buffer of at least N frames
+        to fill instead of allocating.
+
+    Return: (1D structured array) The N frames.
+    """
+
+    x = decodePackets(packets)
+    if out is None:
+        out = np.empty(len(x), dtype=FRAME_DTYPE)
+    out = out[:len(x)]
+
+    out['t']            = ptpToNs(x)
+    out['packet_count'] = x['packet_count']
+    out['packet_info']  = x['packet_info']
+    out['iq']           = x['iq']
+
+    return out
+
+
+def decodeChunk(packets, return_time=False, channels=None, dtype=float):
+    """Decode a chunk of raw packets, see decodePackets().
+    Returns I and Q, or t, I, and Q if return_time.
+    channels: Only decode these channels, see unpackIQ().
+    dtype:    I and Q type, e.g. float (default), np.float32 for half the
+        memory, or None for the raw int32 values as views into packets
+        (valid as long as packets is). Note that raw values can exceed
+        the float16 range.
+    """
+
+    x = decodePackets(packets)
+    I, Q = unpackIQ(x, channels, dtype=dtype)
+
+    if return_time:
+        return ptpToNs(x), I, Q
+
+    return I, Q
+
+
+
+#########################
+### PACKET RING CLASS ###
+
+class PacketRing:
+    """Preallocated ring buffer of raw UDP packets.
+
+    Packets are received straight into the rows of a (size, packet_bytes)
+    uint8 array, so steady state capture does not allocate.
+    Packet number n (counting from 0) lives in row n % size
+    and count is the total number of packets committed so far.
+    The source IP of each packet is kept as a small integer id,
+    see source_addrs.
+    """
+
+    def __init__(self, size, packet_bytes=PACKET_BYTES):
+        self.size         = int(size)
+        self.packet_bytes = int(packet_bytes)
+        self.packets = np.zeros((self.size, self.packet_bytes), dtype=np.uint8)
+        self.lengths = np.zeros(self.size, dtype=np.int32) # bytes received
+        self.sources = np.zeros(self.size, dtype=np.int16) # source ids
+
+        self.source_ids   = {} # source IP: id
+        self.source_addrs = [] # id: source IP
+
+        # writable views of each row, made once and reused by recv_into
+        self._slots = [memoryview(row) for row in self.packets]
+        self.count = 0
+
+
+    def nextSlot(self):
+        """Writable memoryview of the next (uncommitted) row."""
+
+        return self._slots[self.count % self.size]
+
+
+    def commit(self, nbytes, source=0):
+        """Mark the next row as filled with nbytes of packet.
+        source: (int) Source id, see sourceId().
+        """
+
+        i = self.count % self.size
+        self.lengths[i] = nbytes
+        self.sources[i] = source
+        self.count += 1
+
+
+    def sourceId(self, addr):
+        """Small integer id of source IP addr, registered on first sight."""
+
+        sid = self.source_ids.get(addr)
+        if sid is None:
+            sid = self.source_ids[addr] = len(self.source_addrs)
+            self.source_addrs.append(addr)
+        return sid
+
+
+    def recvInto(self, sock):
+        """Receive one packet from sock into the next row.
+        Returns the number of bytes received.
+        """
+
+        nbytes, addr = sock.recvfrom_into(self.nextSlot())
+        self.commit(nbytes, self.sourceId(addr[0]))
+        return nbytes
+
+
+    def view(self, start, stop):
+        """Packets start to stop-1 (absolute packet numbers).
+        Returns a (stop-start, packet_bytes) uint8 view into the ring,
+        or a copy if the range wraps past the end of the ring.
+        """
+
+        return self._take(self.packets, start, stop)
+
+
+    def viewSources(self, start, stop):
+        """Source ids of packets start to stop-1, as view()."""
+
+        return self._take(self.sources, start, stop)
+
+
+    def held(self):
+        """Absolute packet numbers (start, stop) currently held by the ring."""
+
+        return max(self.count - self.size, 0), self.count
+
+
+    def slots(self, start, stop):
+        """Ring row indices of packets start to stop-1."""
+
+        return np.arange(start, stop) % self.size
+
+
+    def _take(self, a, start, stop):
+        """Rows start to stop-1 (absolute packet numbers) of ring array a."""
+
+        if stop < start or stop > self.count or start < self.count - self.size:
+            raise ValueError(
+                f"Packets {start}:{stop} are not in the ring "
+                f"(holds {max(self.count - self.size, 0)}:{self.count}).")
+
+        return self._slice(a, start, stop)
+
+
+    def _slice(self, a, start, stop):
+        """Rows start to stop-1 of ring array a, without checking that
+        the ring still holds them. For readers racing the writer, which
+        check the rows after copying them instead.
+        """
+
+        i0 = start % self.size
+        i1 = i0 + (stop - start)
+        if i1 <= self.size:
+            return a[i0:i1]
+
+        return np.concatenate((a[i0:], a[:i1 - self.size]))
+
+
+    def latest(self, N):
+        """The most recent N packets (fewer if not yet captured)."""
+
+        N = min(N, self.count, self.size)
+        return self.view(self.count - N, self.count)
+
+
+
+##########################
+### PACKET STATS CLASS ###
+
+class PacketStats:
+    """Running packet count accounting for one source (drone).
+
+    Counts are compared to the highest packet count seen so far:
+    a jump of one is in order, a larger jump is a gap of lost packets,
+    and no change is a duplicate. A step back is a late packet: if it
+    fills one of the gaps it is out of order (and no longer lost),
+    otherwise it is a duplicate of a packet already received.
+    Gaps can be filled until they are REORDER_WINDOW packets old,
+    and a step back of more than that is a counter reset (e.g. the
+    board restarted), after which counting carries on from the new count.
+    """
+
+    def __init__(self):
+        self.received     = 0 # packets seen
+        self.lost         = 0 # missing packets (net of late arrivals)
+        self.gaps         = 0 # forward jumps of more than one
+        self.duplicates   = 0 # repeats of packet counts already received
+        self.out_of_order = 0 # late packets that filled a gap
+        self.wraps        = 0 # 32 bit packet count rollovers
+        self.resets       = 0 # packet counter resets
+        self.top = None # highest unwrapped packet count seen
+        self._missing = [] # [start, stop) unwrapped counts of recent gaps
+
+
+    def update(self, counts):
+        """Account for a chunk of packet counts (in arrival order).
+        counts: (1D array of uint32) Packet counts from one source.
+        """
+
+        if len(counts) == 0:
+            return
+
+        c = np.asarray(counts, dtype=np.int64)
+
+        # unwrap: signed 32 bit steps between arrivals
+        # (the first packet is in order by definition)
+        ref = c[0] - 1 if self.top is None else self.top
+        steps = np.diff(c, prepend=ref % 2**32)
+        steps = (steps + 2**31) % 2**32 - 2**31
+        u = ref + np.cumsum(steps)
+
+        self.received += len(c)
+
+        # split the chunk at counter resets
+        top = ref
+        while len(u):
+            tops = np.maximum.accumulate(np.concatenate(([top], u)))
+            reset = np.flatnonzero(u < tops[:-1] - REORDER_WINDOW)
+            stop = reset[0] if len(reset) else len(u)
+            top = self._account(u[:stop], top)
+            if stop == len(u):
+                break
+            self.resets += 1
+            self._missing = [] # the old gaps can't be filled any more
+            top = int(u[stop]) - 1 # carry on in order from the new count
+            u = u[stop:]
+
+        self.top = top
+
+
+    def _account(self, u, top):
+        """Account for unwrapped counts u after the highest count top.
+        Returns the new highest count.
+        """
+
+        if len(u) == 0:
+            return top
+
+        tops = np.maximum.accumulate(np.concatenate(([top], u)))
+        jump = u - tops[:-1]
+
+        gap = jump > 1
+        self.gaps       += int(np.count_nonzero(gap))
+        self.duplicates += int(np.count_nonzero(jump == 0))
+        self.lost       += int(np.sum(jump[gap] - 1))
+        self._missing   += [[int(a) + 1, int(b)] for a, b in zip(tops[:-1][gap], u[gap])]
+
+        # late packets are rare, check each against the gaps
+        for v in u[jump < 0]:
+            if self._fill(int(v)):
+                self.out_of_order += 1
+                self.lost -= 1
+            else:
+                self.duplicates += 1
+
+        new_top = int(tops[-1])
+        self.wraps += max(new_top, 0)//2**32 - max(top, 0)//2**32
+        self._missing = [g for g in self._missing if g[1] > new_top - REORDER_WINDOW]
+
+        return new_top
+
+
+    def _fill(self, v):
+        """Remove count v from the gaps. Returns whether it was missing."""
+
+        for i, (a, b) in enumerate(self._missing):
+            if a <= v < b:
+                self._missing[i:i+1] = [g for g in ([a, v], [v + 1, b]) if g[0] < g[1]]
+                return True
+
+        return False
+
+
+    def asDict(self):
+        """The counters as a dictionary."""
+
+        return {
+            'received':     self.received,
+            'lost':         self.lost,
+            'gaps':         self.gaps,
+            'duplicates':   self.duplicates,
+            'out_of_order': self.out_of_order,
+            'wraps':        self.wraps,
+            'resets':       self.resets}
+
+
+    def __repr__(self):
+        items = ', '.join(f'{k}={v}' for k, v in self.asDict().items())
+        return f'PacketStats({items})'
+
+
+
+################################
+### PACKET INFO EVENTS CLASS ###
+
+class PacketInfoTracker:
+    """Change events of the packet info field of one source (drone).
+
+    The field carries the user bytes written by alcove_base.userPacket()
+    (8 bits per drone, drone 1 in the lowest byte), e.g. as in band
+    markers of sweep or calibration steps. Rather than a value per packet
+    only the changes are kept: the packet count, PTP time, and new value
+    of each packet whose value differs from the one before it.
+    """
+
+    def __init__(self, drid=None, sink=None, maxlen=INFO_EVENTS_MAX):
+        """
+        drid:   (int) Only follow this drone's user byte, see userByte().
+            None for the whole 32 bit field.
+        sink:   (callable) Called with each update's new events,
+            e.g. a timestream_events.EventFile.
+        maxlen: (int) Most recent events kept in events().
+        """
+
+        self.drid = drid
+        self.sink = sink
+        self.value = None # current value
+        self._events = collections.deque(maxlen=maxlen)
+
+
+    def update(self, records):
+        """Find the changes in a chunk of packets (in arrival order).
+        records: (1D structured array) PACKET_DTYPE records, see decodePackets().
+        Return: (1D structured array) INFO_EVENT_DTYPE events.
+        """
+
+        if len(records) == 0:
+            return np.zeros(0, INFO_EVENT_DTYPE)
+
+        v = records['packet_info']
+        if self.drid is not None:
+            v = userByte(v, self.drid)
+
+        prev = -1 if self.value is None else self.value # first packet is a change
+        i = np.flatnonzero(np.diff(v.astype(np.int64), prepend=prev))
+        self.value = int(v[-1])
+
+        events = np.zeros(len(i), INFO_EVENT_DTYPE)
+        if len(i):
+            r = records[i]
+            events['packet_count'] = r['packet_count']
+            events['t']            = ptpToNs(r)
+            events['value']        = v[i]
+            self._events.extend(events.tolist())
+
+        if self.sink is not None:
+            self.sink(events)
+
+        return events
+
+
+    def events(self):
+        """The most recent change events (up to maxlen)."""
+
+        return np.array(list(self._events), dtype=INFO_EVENT_DTYPE)
+
+
+    def __repr__(self):
+        return f'PacketInfoTracker(value={self.value}, events={len(self._events)})'
+
+
+
+##########################
+### SOCKET STATS CLASS ###
+
+class SocketStats:
+    """Kernel side receive accounting of one UDP socket (Linux).
+
+    Packet count gaps (PacketStats) can't tell packets the board never
+    sent from packets the kernel dropped because the socket receive
+    buffer was full. This keeps the kernel's side:
+        rcvbuf:     Receive buffer size granted by the kernel [bytes].
+        rxq_ovfl:   Packets dropped on this socket, from the SO_RXQ_OVFL
+            count the kernel attaches to received packets.
+        proc_drops: The drops column of /proc/net/udp for this socket.
+        rx_queue:   Bytes waiting in the receive queue when last sampled.
+    """
+
+    def __init__(self, sock, rcvbuf=RCVBUF_BYTES):
+        """
+        sock:   (socket) Bound UDP socket.
+        rcvbuf: (int) Receive buffer target [bytes], None to leave as is.
+        """
+
+        self.sock = sock
+        self.inode = os.fstat(sock.fileno()).st_ino # finds it in /proc/net/udp
+
+        self.rcvbuf_target = rcvbuf
+        self.rcvbuf = setRcvbuf(sock, rcvbuf) if rcvbuf else \
+            sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+            self.rxq_ovfl_enabled = True
+        except OSError:
+            self.rxq_ovfl_enabled = False
+        self._cmsg_size = socket.CMSG_SPACE(4)
+
+        self.rxq_ovfl   = 0
+        self.proc_drops = None
+        self.rx_queue   = None
+        self._sampled   = 0. # monotonic time of the last /proc sample
+
+
+    def recvfrom_into(self, slot):
+        """The socket's recvfrom_into(), picking up the kernel's drop count
+        on the way. Stands in for the socket in PacketRing.recvInto().
+        Returns the number of bytes and the source address.
+        """
+
+        if not self.rxq_ovfl_enabled:
+            return self.sock.recvfrom_into(slot)
+
+        nbytes, anc, _, addr = self.sock.recvmsg_into([slot], self._cmsg_size)
+        for level, kind, data in anc: # only present once there are drops
+            if level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL:
+                self.rxq_ovfl = int.from_bytes(data[:4], sys.byteorder)
+
+        return nbytes, addr
+
+
+    def sample(self, period=0):
+        """Read this socket's /proc/net/udp line,
+        unless it was read less than period seconds ago.
+        """
+
+        now = time.monotonic()
+        if now - self._sampled < period:
+            return
+        self._sampled = now
+
+        try:
+            with open('/proc/net/udp') as f:
+                lines = f.readlines()[1:]
+        except OSError:
+            return
+
+        inode = str(self.inode)
+        for line in lines:
+            col = line.split()
+            if len(col) > 12 and col[9] == inode:
+                self.rx_queue   = int(col[4].split(':')[1], 16)
+                self.proc_drops = int(col[12])
+                return
+
+
+    def asDict(self):
+        """The counters as a dictionary."""
+
+        return {
+            'rcvbuf':     self.rcvbuf,
+            'rxq_ovfl':   self.rxq_ovfl,
+            'proc_drops': self.proc_drops,
+            'rx_queue':   self.rx_queue}
+
+
+    def __repr__(self):
+        items = ', '.join(f'{k}={v}' for k, v in self.asDict().items())
+        return f'SocketStats({items})'
+
+
+def setRcvbuf(sock, nbytes):
+    """Ask for a socket receive buffer of nbytes.
+    SO_RCVBUFFORCE (needs CAP_NET_ADMIN) can exceed net.core.rmem_max,
+    plain SO_RCVBUF is capped by it.
+    Returns the size the kernel granted, warning if it falls short.
+    """
+
+    # the kernel doubles the request to cover its overhead
+    request = max(nbytes//2, 1)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, request)
+    except OSError:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, request)
+
+    granted = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    if granted < nbytes:
+        print(f"Socket receive buffer is {granted} bytes, short of {nbytes}. "
+              f"Raise net.core.rmem_max (sysctl) to reach it.")
+
+    return granted
+
+
+
 ########################
 ### TIMESTREAM CLASS ###
 
 class TimeStream:
-    def __init__(self, host, port):
+    def __init__(self, host, port, ring_size=None, ring=None, rcvbuf=RCVBUF_BYTES):
+        """
+        host:      (str) IP address to bind to.
+        port:      (int) UDP port to bind to.
+        ring_size: (int) Packets held in the capture ring buffer.
+            If None the ring is sized on first use from the chunk size.
+        ring:      (PacketRing) Capture into this ring instead,
+            e.g. a timestream_shm.SharedPacketRing.
+        rcvbuf:    (int) Socket receive buffer target [bytes],
+            None to keep the system default.
+        """
+
+        # background capture
+        # (first, so __del__ works even if the bind below fails)
+        self._thread = None
+        self._stop = threading.Event()
+        self._new_data = threading.Condition()
+        self._cursor = 0 # next packet for getTimeStreamChunk
+
         self.host = host
         self.port = port
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.bind((self.host, self.port))
+        self.sock_stats = SocketStats(self.sock, rcvbuf)
+
+        if ring is None and ring_size:
+            ring = PacketRing(ring_size)
+        self.ring = ring
+        self.stats = {} # source IP: PacketStats
+        self.info  = {} # source IP: PacketInfoTracker
 
 
     def capturePacket(self, buffer_size=9000):
@@ -36,30 +695,269 @@ class TimeStream:
         return np.array([self.capturePacket(buffer_size) for _ in range(N)])
     
 
+    def captureNpacketsRing(self, N):
+        """Capture N packets straight into the ring buffer.
+        Returns a (N, PACKET_BYTES) uint8 view into the ring.
+        The view is only valid until the ring wraps around onto it,
+        and is a copy if the chunk straddles the end of the ring
+        (which never happens if the ring size is a multiple of N).
+        A ring smaller than N is replaced by a larger one first
+        (or, for a ring passed in, e.g. a shared ring, this raises).
+        """
+
+        if self.capturing():
+            raise RuntimeError("Background capture owns the socket.")
+
+        if self.ring is None or (N > self.ring.size and type(self.ring) is PacketRing):
+            self.ring = PacketRing(max(min(N*RING_CHUNKS, RING_SIZE), N))
+        if N > self.ring.size:
+            raise ValueError(
+                f"Can't capture {N} packets into a ring of {self.ring.size}.")
+
+        ring, sock = self.ring, self.sock_stats # counts kernel drops
+        for _ in range(N):
+            ring.recvInto(sock)
+
+        self.updateStats(max(ring.count - N, ring.held()[0]), ring.count)
+
+        return ring.latest(N)
+
+
+    def updateStats(self, start, stop):
+        """Update the per source packet stats and packet info events
+        with ring packets start to stop-1,
+        and the socket stats if they are due a sample.
+        """
+
+        self.sock_stats.sample(SOCKET_SAMPLE_S)
+
+        x       = decodePackets(self.ring.view(start, stop))
+        sources = self.ring.viewSources(start, stop)
+
+        for sid in np.unique(sources):
+            addr = self.ring.source_addrs[sid]
+            if addr not in self.stats:
+                self.stats[addr] = PacketStats()
+                self.info[addr]  = PacketInfoTracker()
+            xs = x[sources == sid]
+            self.stats[addr].update(xs['packet_count'])
+            self.info[addr].update(xs)
+
+
     def byteshiftPackets(self, packets, byteshift=-1):
         return np.array([
             np.roll(p, byteshift) 
             for p in packets])
     
 
-    def convertPackets(self, packets):
+    def convertPackets(self, packets, dtype="float"):
         return np.array([
-            np.frombuffer(p, dtype="<i").astype("float")
+            np.frombuffer(p, dtype="<i").astype(dtype)
             for p in packets])
     
 
-    def getTimeStreamChunk(self, N):
+    def getTimeStreamChunk(self, N, return_time=False, channels=None, dtype=float):
         """Grab a chunk of N packets from the timestream.
-        Returns I and Q.
+        Returns I and Q, or t, I, and Q if return_time.
+        channels: Only decode these channels, see unpackIQ().
+        dtype:    I and Q type, see decodeChunk().
+        t is the PTP time of each packet in int64 nanoseconds.
+        During background capture this is the next N packets
+        after the previous chunk, waiting for them if needed.
+        """
+
+        if self.capturing():
+            with self._new_data:
+                self._new_data.wait_for(
+                    lambda: self.ring.count >= self._cursor + N
+                            or not self.capturing())
+            start = max(self._cursor, self.ring.count - self.ring.size + 1)
+            x, self._cursor = self._readPackets(start, start + N)
+
+        else:
+            x = self.captureNpacketsRing(N)
+
+        return decodeChunk(x, return_time, channels, dtype)
+
+
+    ##################################
+    ### background capture methods ###
+
+    def startCapture(self, ring_size=RING_SIZE):
+        """Start draining the socket into the ring in a background thread.
+        Consumers then read with getLatest(), getSince(),
+        or getTimeStreamChunk(), and never block the capture.
+
+        ring_size: (int) Ring size, if the ring doesn't exist yet.
+        """
+
+        if self.capturing():
+            return
+
+        if self.ring is None:
+            self.ring = PacketRing(ring_size)
+
+        self._cursor = self.ring.count
+        self._stop.clear()
+        self.sock.settimeout(0.1) # so the thread notices stopCapture
+        self._thread = threading.Thread(
+            target=self._captureLoop, name='timestream_capture', daemon=True)
+        self._thread.start()
+
+
+    def stopCapture(self):
+        """Stop the background capture thread."""
+
+        if not self.capturing():
+            return
+
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.sock.settimeout(None)
+        with self._new_data:
+            self._new_data.notify_all()
+
+
+    def capturing(self):
+        """True if the background capture thread is running."""
+
+        return self._thread is not None and self._thread.is_alive()
+
+
+    def _captureLoop(self):
+        ring, sock = self.ring, self.sock_stats # counts kernel drops
+        accounted = ring.count
+
+        while not self._stop.is_set():
+            try:
+                ring.recvInto(sock)
+            except socket.timeout:
+                pass
+            else:
+                with self._new_data:
+                    self._new_data.notify_all()
+                if ring.count - accounted < STATS_BATCH:
+                    continue
+
+            if ring.count > accounted:
+                self.updateStats(max(accounted, ring.held()[0]), ring.count)
+                accounted = ring.count
+
+
+    def _readPackets(self, start, stop):
+        """Copy of ring packets start to stop-1, safe against the
+        capture thread overwriting them mid copy.
+        Returns the packets and the packet number after the last one.
+        Packets already overwritten are skipped.
+        """
+
+        ring = self.ring
+        while True:
+            count = ring.count # the writer moves on while we copy
+            start = max(start, count - ring.size + 1, 0) # +1: row being written
+            stop = max(min(stop, count), start)
+            x = np.array(ring._slice(ring.packets, start, stop)) # copy
+            if start > ring.count - ring.size: # still intact after copy
+                return x, stop
+
+
+    def getLatest(self, N, return_time=False, channels=None, dtype=float):
+        """The latest N packets (or fewer) already captured.
+        Returns I and Q, or t, I, and Q if return_time.
+        channels: Only decode these channels, see unpackIQ().
+        dtype:    I and Q type, see decodeChunk().
+        """
+
+        count = self.ring.count
+        x, _ = self._readPackets(count - N, count)
+
+        return decodeChunk(x, return_time, channels, dtype)
+
+
+    def getRawSince(self, cursor):
+        """All raw packets captured since cursor, see getSince().
+        Return: cursor, and a (N, PACKET_BYTES) uint8 copy of the packets.
+        """
+
+        count = self.ring.count
+        if cursor is None:
+            cursor = count
+
+        x, cursor = self._readPackets(cursor, count)
+
+        return cursor, x
+
+
+    def getSince(self, cursor, return_time=False, channels=None, dtype=float):
+        """All packets captured since cursor (a packet number).
+        Start with cursor 0 (or None for only new packets) and pass
+        the returned cursor back in on the next call.
+        Packets overwritten before being read are skipped.
+
+        Return: cursor, then I and Q, or t, I, and Q if return_time.
+        channels: Only decode these channels, see unpackIQ().
+        dtype:    I and Q type, see decodeChunk().
+        """
+
+        cursor, x = self.getRawSince(cursor)
+
+        return (cursor, *decodeChunk(x, return_time, channels, dtype))
+
+
+    def getTimeRange(self, t0=None, t1=None, source=None, channels=None,
+                     dtype=float):
+        """Packets already in the ring with PTP time t0 <= t < t1.
+        No packets are captured.
+
+        t0, t1:   (int) PTP time bounds in nanoseconds (None for open ended).
+        source:   (str) Only packets from this source IP (None for all).
+        channels: Only decode these channels, see unpackIQ().
+        dtype:    I and Q type, see decodeChunk().
+
+        Return: t, I, and Q in capture order.
+        Safe during background capture: the matching packets are copied
+        and only returned if the capture didn't overwrite them meanwhile.
         """
 
-        x = self.captureNpackets(N)
-        x = self.byteshiftPackets(x)
-        x = self.convertPackets(x)
+        if self.ring is None:
+            raise ValueError("Nothing captured yet.")
+
+        ring = self.ring
+        x = decodePackets(ring.packets) # whole ring, no copy
+        lag = 1 if self.capturing() else 0 # row being written
+        while True:
+            n = np.arange(max(ring.count - ring.size + lag, 0), ring.count) # packet numbers
+            rows = n % ring.size
+
+            t = ptpToNs(x)[rows]
+            keep = np.ones(len(rows), dtype=bool)
+            if t0 is not None:
+                keep &= t >= t0
+            if t1 is not None:
+                keep &= t < t1
+            if source is not None:
+                sid = ring.source_ids.get(source, -1)
+                keep &= ring.sources[rows] == sid
 
-        I, Q = x[:,16::2].T, x[:,17::2].T
-        
-        return I, Q
+            n, t = n[keep], t[keep]
+            xk = x[rows[keep]] # copy
+            if not len(n) or n[0] >= ring.count - ring.size + lag: # still intact after copy
+                break
+
+        I, Q = unpackIQ(xk, channels, dtype)
+
+        return t, I, Q
+
+
+    def allStats(self):
+        """Packet stats of each source and the socket stats, sampled now."""
+
+        self.sock_stats.sample()
+
+        return {
+            'sources': {addr: st.asDict() for addr, st in self.stats.items()},
+            'socket':  self.sock_stats.asDict()}
 
 
     # def send_message(self, message, address):
@@ -67,6 +965,158 @@ class TimeStream:
 
 
     def __del__(self):
+        self.stopCapture()
         self.sock.close()
 
 
+
+##############################
+### MULTI TIMESTREAM CLASS ###
+
+class MultiTimeStream:
+    """Capture several timestream sockets from one thread.
+
+    All sockets are multiplexed with selectors (epoll on Linux)
+    and each packet is demultiplexed by its source IP
+    into a per source (i.e. per drone) PacketRing.
+    The packet stats of each source are kept as in TimeStream.
+
+    Each packet is received into a scratch slot and copied into its
+    source's ring once the source is known, so a packet from another
+    (or an unlisted) source never lands on a ring's held packets.
+
+    Every source has its own ring of ring_size*PACKET_BYTES bytes,
+    e.g. 16 drones with the default MULTI_RING_SIZE (4 s at 500 packets/s)
+    hold ~270 MB. With sources=None each new source IP allocates one.
+    """
+
+    def __init__(self, binds, sources=None, ring_size=MULTI_RING_SIZE,
+                 rcvbuf=RCVBUF_BYTES):
+        """
+        binds:     (list) (host, port) tuples to bind a socket to,
+            e.g. one per receiving NIC.
+        sources:   (list) Source IPs to capture, e.g. the drone origin IPs
+            ip_addr.tIP_origin(drid) of each board.
+            If None every source is captured as it shows up.
+        ring_size: (int) Packets held in each per source ring.
+        rcvbuf:    (int) Receive buffer target of each socket [bytes],
+            None to keep the system default.
+        """
+
+        self.ring_size = ring_size
+        self.rings = {} # source IP: PacketRing
+        self.stats = {} # source IP: PacketStats
+        self.info  = {} # source IP: PacketInfoTracker
+        self.unknown = 0 # packets dropped from unlisted sources
+        self.fixed_sources = sources is not None
+        for addr in (sources or []):
+            self._addSource(addr)
+
+        self._accounted = {} # source IP: ring count already in stats
+        self._scratch = memoryview(bytearray(PACKET_BYTES)) # landing slot
+
+        self.sel = selectors.DefaultSelector()
+        self.socks = []
+        self.sock_stats = {} # (host, port): SocketStats
+        for host, port in binds:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind((host, port))
+            sock.setblocking(False)
+            self.sock_stats[(host, port)] = SocketStats(sock, rcvbuf)
+            self.sel.register(sock, selectors.EVENT_READ)
+            self.socks.append(sock)
+        self._recv = {s.sock: s.recvfrom_into for s in self.sock_stats.values()}
+
+
+    def _addSource(self, addr):
+        """Create the ring and stats of a new source IP."""
+
+        self.rings[addr] = PacketRing(self.ring_size)
+        self.stats[addr] = PacketStats()
+        self.info[addr]  = PacketInfoTracker()
+        return self.rings[addr]
+
+
+    def poll(self, timeout=None):
+        """Wait up to timeout seconds for packets and drain every
+        readable socket into the source rings.
+        Returns the number of packets received.
+        """
+
+        n = 0
+        for key, _ in self.sel.select(timeout):
+            n += self._drain(key)
+
+        if n:
+            self.updateStats()
+
+        return n
+
+
+    def _drain(self, key):
+        """Receive every packet waiting on a registered socket."""
+
+        sock, rings = key.fileobj, self.rings
+        recv, slot = self._recv[sock], self._scratch
+
+        n = 0
+        while True:
+            try:
+                nbytes, addr = recv(slot)
+            except BlockingIOError:
+                break
+
+            ring = rings.get(addr[0])
+            if ring is None:
+                if self.fixed_sources:
+                    self.unknown += 1
+                    continue
+                ring = self._addSource(addr[0])
+
+            ring.nextSlot()[:nbytes] = slot[:nbytes]
+            ring.commit(nbytes)
+            n += 1
+
+        return n
+
+
+    def updateStats(self):
+        """Update the packet stats and packet info events with packets
+        received since last time, and the socket stats if they are due a sample.
+        """
+
+        for stats in self.sock_stats.values():
+            stats.sample(SOCKET_SAMPLE_S)
+
+        for addr, ring in self.rings.items():
+            start = max(self._accounted.get(addr, 0), ring.held()[0])
+            if ring.count > start:
+                x = decodePackets(ring.view(start, ring.count))
+                self.stats[addr].update(x['packet_count'])
+                self.info[addr].update(x)
+                self._accounted[addr] = ring.count
+
+
+    def run(self, duration=None, timeout=0.1):
+        """Capture continuously for duration seconds (None for forever)."""
+
+        t_end = None if duration is None else time.monotonic() + duration
+        while t_end is None or time.monotonic() < t_end:
+            self.poll(timeout)
+
+
+    def getLatest(self, source, N, return_time=False, channels=None, dtype=float):
+        """The latest N packets captured from source IP.
+        Returns I and Q, or t, I, and Q if return_time.
+        channels: Only decode these channels, see unpackIQ().
+        dtype:    I and Q type, see decodeChunk().
+        """
+
+        return decodeChunk(self.rings[source].latest(N), return_time, channels, dtype)
+
+
+    def close(self):
+        for sock in self.socks:
+            self.sel.unregister(sock)
+            sock.close()
+        self.sel.close()
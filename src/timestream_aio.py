@@ -0,0 +1,187 @@
+# ============================================================================ #
+# timestream_aio.py
+# asyncio timestream receiver, for capture sharing an event loop.
+# James Burgoyne jburgoyne@phas.ubc.ca
+# CCAT Prime 2024
+# ============================================================================ #
+
+
+
+# ============================================================================ #
+# IMPORTS & GLOBALS
+# ============================================================================ #
+
+
+import asyncio
+import socket
+import numpy as np
+
+from timestream import (
+    PacketStats, SocketStats, PACKET_BYTES, RCVBUF_BYTES, SOCKET_SAMPLE_S,
+    decodePackets, decodeChunk)
+
+
+
+# ============================================================================ #
+# TimeStreamProtocol
+# ============================================================================ #
+
+
+class TimeStreamProtocol(asyncio.DatagramProtocol):
+    """asyncio datagram protocol batching packets into chunks.
+
+    Packets are copied into a small pool of preallocated
+    (chunk_size, PACKET_BYTES) buffers as they arrive. Full chunks are
+    queued and decoded when the consumer iterates:
+
+        transport, ts = await openTimeStream('192.168.3.40', 4096)
+        async for t, I, Q in ts:
+            ...
+
+    If the consumer falls behind until no buffer is free, the oldest
+    queued chunk is overwritten and counted in chunks_dropped,
+    so memory stays fixed.
+    """
+
+    def __init__(self, chunk_size=100, n_chunks=8, channels=None, dtype=float):
+        """
+        chunk_size: (int) Packets per chunk.
+        n_chunks:   (int) Preallocated chunk buffers (at least 2).
+        channels:   Only decode these channels, see unpackIQ().
+        dtype:      I and Q type, see decodeChunk() (not None: the
+            buffers are reused once the chunk is handed out).
+        """
+
+        self.chunk_size = int(chunk_size)
+        self.channels   = channels
+        self.dtype      = dtype
+
+        self._buffers = np.zeros((max(n_chunks, 2), self.chunk_size, PACKET_BYTES), np.uint8)
+        self._sources = [[None]*self.chunk_size for _ in self._buffers]
+        self._free  = list(range(1, len(self._buffers)))
+        self._full  = asyncio.Queue()
+        self._buf   = 0 # buffer being filled
+        self._n     = 0 # packets in it
+
+        self.transport = None
+        self.sock_stats = None # SocketStats (proc_drops only), see openTimeStream()
+        self.stats = {} # source IP: PacketStats
+        self.chunks_dropped = 0
+        self.bad_packets = 0 # datagrams of the wrong size
+
+
+    # ======================================================================== #
+    # asyncio callbacks
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+
+    def datagram_received(self, data, addr):
+        if len(data) != PACKET_BYTES:
+            self.bad_packets += 1
+            return
+
+        b, n = self._buf, self._n
+        self._buffers[b, n] = np.frombuffer(data, np.uint8)
+        self._sources[b][n] = addr[0]
+        self._n = n + 1
+
+        if self._n == self.chunk_size:
+            self._queueChunk()
+
+
+    def error_received(self, exc):
+        pass # e.g. ICMP port unreachable, nothing to do for a receiver
+
+
+    def connection_lost(self, exc):
+        if self._n:
+            self._queueChunk() # partial last chunk
+        self._full.put_nowait(None) # ends iteration
+
+
+    # ======================================================================== #
+    # chunks
+
+    def _queueChunk(self):
+        """Queue the filled buffer and move on to a free one."""
+
+        b, n = self._buf, self._n
+        counts = decodePackets(self._buffers[b, :n])['packet_count']
+        srcs = np.array(self._sources[b][:n])
+        for addr in map(str, np.unique(srcs)):
+            if addr not in self.stats:
+                self.stats[addr] = PacketStats()
+            self.stats[addr].update(counts[srcs == addr])
+        if self.sock_stats is not None:
+            self.sock_stats.sample(SOCKET_SAMPLE_S)
+
+        self._full.put_nowait((b, n))
+
+        if self._free:
+            self._buf = self._free.pop()
+        else: # consumer is behind: reuse the oldest queued chunk
+            self._buf, _ = self._full.get_nowait()
+            self.chunks_dropped += 1
+        self._n = 0
+
+
+    def __aiter__(self):
+        return self
+
+
+    async def __anext__(self):
+        """The next chunk decoded as t [ns], I, and Q, see decodeChunk()."""
+
+        item = await self._full.get()
+        if item is None:
+            self._full.put_nowait(None) # stay finished
+            raise StopAsyncIteration
+
+        b, n = item
+        try:
+            t, I, Q = decodeChunk(self._buffers[b, :n], True, self.channels, self.dtype)
+        finally:
+            self._free.append(b)
+
+        return t, I, Q
+
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+
+# ============================================================================ #
+# openTimeStream
+async def openTimeStream(host, port, chunk_size=100, n_chunks=8, channels=None,
+                         dtype=float, rcvbuf=RCVBUF_BYTES):
+    """Bind a TimeStreamProtocol on the running event loop.
+
+    host, port: Address to bind to.
+    rcvbuf:     (int) Socket receive buffer target [bytes],
+        None to keep the system default.
+    Remaining arguments are passed to TimeStreamProtocol.
+
+    Return: The transport and the protocol (an async iterator of chunks).
+    The protocol's sock_stats only has the /proc/net/udp drop count:
+    asyncio receives with recvfrom(), which drops the ancillary data
+    SO_RXQ_OVFL comes in, so rxq_ovfl is None.
+    """
+
+    loop = asyncio.get_running_loop()
+
+    # bound here so the receive buffer is set as in TimeStream
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((host, port))
+    sock_stats = SocketStats(sock, rcvbuf)
+    sock_stats.rxq_ovfl = None # not available, see above
+
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: TimeStreamProtocol(chunk_size, n_chunks, channels, dtype),
+        sock=sock)
+    protocol.sock_stats = sock_stats
+
+    return transport, protocol
@@ -0,0 +1,190 @@
+# ============================================================================ #
+# timestream_cal.py
+# Timestream I/Q to phase and frequency shift calibration from target sweeps.
+# James Burgoyne jburgoyne@phas.ubc.ca
+# CCAT Prime 2024
+# ============================================================================ #
+
+
+
+# ============================================================================ #
+# IMPORTS & GLOBALS
+# ============================================================================ #
+
+
+import numpy as np
+
+from timestream import N_CHANNELS
+
+
+
+# ============================================================================ #
+# Calibration
+# ============================================================================ #
+
+
+class Calibration:
+    """Per resonator I/Q calibration from a target sweep.
+
+    Each resonator's sweep is fit with a circle (all resonators at once),
+    giving the centre, radius, and the angle of the resonance point on
+    the circle. A timestream sample is then converted to the phase angle
+    around the centre, zero at resonance, and to a resonance frequency
+    shift with the slope of that angle against frequency in the sweep.
+    Whole chunks of all channels convert in one vectorized pass.
+
+    The sweep S21 and the timestream I/Q are assumed to be on the same
+    scale (both are the channelizer I/Q).
+    """
+
+    def __init__(self, f_res, s21, fit_width=None, slope_width=5):
+        """
+        f_res:       (1D array of float) Resonator frequencies [Hz] (f_res_targ).
+        s21:         (2, M) The target sweep (s21_targ): bin frequencies [Hz]
+            and complex S21, M = len(f_res)*N_steps, resonator by resonator.
+        fit_width:   (int) Only fit the circle to this many sweep points
+            around each resonance (default all of them).
+        slope_width: (int) Sweep points either side of resonance
+            in the phase slope fit.
+        """
+
+        f_res = np.real(np.asarray(f_res)).astype(float)
+        n_res = len(f_res)
+
+        f = np.real(s21[0]).reshape(n_res, -1)
+        z = np.asarray(s21[1], dtype=complex).reshape(n_res, -1)
+        n_steps = f.shape[1]
+        rows = np.arange(n_res)[:, None]
+
+        # sweep point nearest each resonance
+        i_res = np.argmin(np.abs(f - f_res[:, None]), axis=1)
+
+        # circle fit
+        if fit_width:
+            k = np.arange(fit_width) - fit_width//2
+            idx = np.clip(i_res[:, None] + k, 0, n_steps - 1)
+            zc, r = _fitCircles(z[rows, idx])
+        else:
+            zc, r = _fitCircles(z)
+
+        # angle of each sweep point around its centre, zero at resonance
+        theta = np.angle(z - zc[:, None])
+        theta0 = theta[np.arange(n_res), i_res]
+        theta = np.unwrap(theta - theta0[:, None], axis=1)
+
+        # phase slope at resonance [rad/Hz]
+        k = np.arange(-slope_width, slope_width + 1)
+        idx = np.clip(i_res[:, None] + k, 0, n_steps - 1)
+        fs, ts = f[rows, idx], theta[rows, idx]
+        fs = fs - fs.mean(axis=1, keepdims=True)
+        ts = ts - ts.mean(axis=1, keepdims=True)
+        slope = np.sum(fs*ts, axis=1)/np.sum(fs**2, axis=1)
+
+        # move the zero from the nearest sweep point onto f_res itself
+        theta0 = theta0 + slope*(f_res - f[np.arange(n_res), i_res])
+
+        # per channel parameters, NaN for channels without a resonator
+        n = max(n_res, N_CHANNELS)
+        def pad(a):
+            out = np.full(n, np.nan)
+            out[:n_res] = a
+            return out
+
+        self.n_res  = n_res
+        self.f_res  = f_res
+        self.xc     = pad(zc.real)
+        self.yc     = pad(zc.imag)
+        self.radius = pad(r)
+        self.theta0 = pad(theta0)
+        self.dphi_df = pad(slope)
+
+
+    @classmethod
+    def fromTargetSweep(cls, timestamp=None, **kwargs):
+        """Calibration from the drone's latest (or the given timestamp's)
+        s21_targ and f_res_targ files.
+        kwargs: Passed to Calibration().
+        """
+
+        import alcove_commands.board_io as io
+
+        if timestamp is None:
+            f_res = io.load(io.file.f_res_targ)
+            s21   = io.load(io.file.s21_targ)
+        else:
+            f_res = io.loadVersion(io.file.f_res_targ, timestamp)
+            s21   = io.loadVersion(io.file.s21_targ, timestamp)
+
+        return cls(f_res, s21, **kwargs)
+
+
+    def _params(self, n, channels):
+        """Calibration parameters as columns for n rows of channels."""
+
+        idx = slice(0, n) if channels is None else np.asarray(channels)
+
+        return [a[idx, None] for a in (self.xc, self.yc, self.theta0, self.dphi_df)]
+
+
+    def phase(self, I, Q, channels=None):
+        """Phase [rad] around each resonance circle, zero at resonance.
+
+        I, Q:     (2D arrays) Timestream chunk (channels, N).
+        channels: The channels the rows are, if a subset was decoded
+            (see unpackIQ()), otherwise the rows are channels 0, 1, ...
+        """
+
+        xc, yc, theta0, _ = self._params(len(I), channels)
+
+        p = np.arctan2(Q - yc, I - xc)
+        p -= theta0
+        p += np.pi
+        np.mod(p, 2*np.pi, out=p)
+        p -= np.pi
+
+        return p
+
+
+    def df(self, I, Q, channels=None):
+        """Resonance frequency shift [Hz] of each sample.
+        Arguments as phase().
+        """
+
+        slope = self._params(len(I), channels)[3]
+
+        # a tone below resonance sees it move up, so the shift opposes the slope
+        x = self.phase(I, Q, channels)
+        x /= -slope
+
+        return x
+
+
+
+# ============================================================================ #
+# INTERNAL FUNCTIONS
+# ============================================================================ #
+
+
+# ============================================================================ #
+# _fitCircles
+def _fitCircles(z):
+    """Algebraic (Kasa) least squares circle fit of each row of z.
+
+    z: (2D array of complex) One set of points per row.
+
+    Return: The centres (complex) and radii.
+    """
+
+    x, y = z.real, z.imag
+
+    # x**2 + y**2 = a*x + b*y + c, normal equations batched over rows
+    A = np.stack((x, y, np.ones_like(x)), axis=-1)   # (rows, M, 3)
+    rhs = x**2 + y**2
+    ATA = np.einsum('rmi,rmj->rij', A, A)
+    ATb = np.einsum('rmi,rm->ri', A, rhs)
+    a, b, c = np.linalg.solve(ATA, ATb[..., None])[..., 0].T
+
+    zc = (a + 1j*b)/2
+    r = np.sqrt(c + np.abs(zc)**2)
+
+    return zc, r
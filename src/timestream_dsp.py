@@ -0,0 +1,383 @@
+# ============================================================================ #
+# timestream_dsp.py
+# Streaming signal processing stages for decoded timestream chunks.
+# James Burgoyne jburgoyne@phas.ubc.ca
+# CCAT Prime 2024
+# ============================================================================ #
+
+
+
+# ============================================================================ #
+# IMPORTS & GLOBALS
+# ============================================================================ #
+
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+
+# ============================================================================ #
+# Decimator
+# ============================================================================ #
+
+
+class Decimator:
+    """Streaming anti-alias filter and downsampler.
+
+    Feed consecutive chunks of shape (channels, N) (or (N,)), e.g. the
+    I and Q from TimeStream.getTimeStreamChunk(), and get the decimated
+    chunks back. Filter state is carried across chunks, so the output is
+    the same however the input is chunked. All channels are filtered in
+    one vectorized pass.
+
+    Modes:
+        boxcar: Mean of each block of factor samples.
+        cic:    Order cascaded boxcars (the response of a CIC filter).
+        fir:    Windowed sinc low pass at the output Nyquist frequency.
+    """
+
+    def __init__(self, factor, mode='boxcar', order=3, ntaps=None):
+        """
+        factor: (int) Decimation factor.
+        mode:   (str) {'boxcar', 'cic', 'fir'}.
+        order:  (int) CIC order (cic mode).
+        ntaps:  (int) FIR length (fir mode), default 8*factor + 1.
+        """
+
+        self.factor = int(factor)
+        self.mode   = mode
+
+        if mode == 'boxcar':
+            h = np.ones(self.factor)
+        elif mode == 'cic':
+            h = np.ones(1)
+            for _ in range(int(order)):
+                h = np.convolve(h, np.ones(self.factor))
+        elif mode == 'fir':
+            h = _firTaps(self.factor, ntaps or 8*self.factor + 1)
+        else:
+            raise ValueError(f"Unknown decimation mode: {mode}")
+
+        self.taps = h/np.sum(h) # unity gain at DC
+        self._h = self.taps[::-1].copy() # reversed for the window product
+        self.reset()
+
+
+    def reset(self):
+        """Forget the filter state (e.g. after a gap in the data)."""
+
+        self._buf  = None # samples from the next output window on
+        self._tbuf = None # their times
+        self._skip = 0    # samples to drop before the next window starts
+
+
+    def process(self, x, t=None):
+        """Filter and decimate the next chunk.
+
+        x: (array) Shape (channels, N) or (N,), real or complex.
+        t: (1D array of int) Optional sample times, e.g. PTP nanoseconds.
+
+        Return: The decimated chunk (channels, M), or t and the chunk if
+            t was given (the time of each window's centre sample).
+        """
+
+        x = np.asarray(x)
+        if not np.issubdtype(x.dtype, np.inexact):
+            x = x.astype(float)
+
+        if self._skip:
+            d = min(self._skip, x.shape[-1])
+            x = x[..., d:]
+            t = None if t is None else t[d:]
+            self._skip -= d
+
+        buf = x if self._buf is None else np.concatenate((self._buf, x), axis=-1)
+        if t is not None:
+            tbuf = t if self._tbuf is None else np.concatenate((self._tbuf, t))
+
+        R, ntaps, L = self.factor, len(self._h), buf.shape[-1]
+        n_out = 0 if L < ntaps else (L - ntaps)//R + 1
+
+        if n_out:
+            windows = sliding_window_view(buf, ntaps, axis=-1)[..., :n_out*R:R, :]
+            y = windows @ self._h
+        else:
+            y = np.zeros(buf.shape[:-1] + (0,), dtype=np.result_type(buf, self._h))
+
+        # keep what the following windows need
+        s_next = n_out*R
+        self._buf = buf[..., s_next:].copy()
+        self._skip = max(s_next - L, 0)
+        if t is not None:
+            t_out = tbuf[(ntaps - 1)//2:][:s_next:R]
+            self._tbuf = tbuf[s_next:].copy()
+            return t_out, y
+
+        return y
+
+
+
+# ============================================================================ #
+# NoisePSD
+# ============================================================================ #
+
+
+class NoisePSD:
+    """Running Welch power spectral density of every channel.
+
+    Feed consecutive chunks of shape (channels, N), e.g. phase or
+    frequency shift timestreams, and ask for the current estimate with
+    psd() at any time. Complete segments are windowed and transformed
+    together, one batched FFT over all channels and segments of a chunk.
+    Only the partial segment at the end of the data is kept between
+    chunks, so memory doesn't grow with the length of the stream.
+    """
+
+    def __init__(self, fs, nperseg=1024, overlap=0.5, alpha=None):
+        """
+        fs:      (float) Sample rate [Hz], e.g. the packet rate.
+        nperseg: (int) Segment length; the frequency resolution is fs/nperseg.
+        overlap: (float) Fraction of a segment shared with the next.
+        alpha:   (float) If given, average segments with this exponential
+            forgetting factor instead of equally, so the estimate follows
+            changes (e.g. while tuning).
+        """
+
+        self.fs      = float(fs)
+        self.nperseg = int(nperseg)
+        self.step    = self.nperseg - int(overlap*self.nperseg)
+        self.alpha   = alpha
+
+        self.window = np.hanning(self.nperseg + 1)[:-1] # periodic Hann
+        self.scale  = 1/(self.fs*np.sum(self.window**2))
+        self.reset()
+
+
+    def reset(self):
+        """Start a new estimate."""
+
+        self._buf = None
+        self._acc = None # sum (or exponential average) of periodograms
+        self.n_segments = 0
+        self.is_complex = False
+
+
+    def update(self, x):
+        """Add a chunk to the estimate.
+        x: (array) Shape (channels, N) or (N,), real or complex (e.g. I + 1j*Q).
+        """
+
+        x = np.asarray(x)
+        buf = x if self._buf is None else np.concatenate((self._buf, x), axis=-1)
+
+        L, n = buf.shape[-1], self.nperseg
+        n_seg = 0 if L < n else (L - n)//self.step + 1
+
+        if n_seg:
+            segs = sliding_window_view(buf, n, axis=-1)[..., :n_seg*self.step:self.step, :]
+            segs = segs - segs.mean(axis=-1, keepdims=True) # constant detrend
+
+            self.is_complex = np.iscomplexobj(segs)
+            fft = np.fft.fft if self.is_complex else np.fft.rfft
+            P = np.abs(fft(segs*self.window, axis=-1))**2 # (..., n_seg, freqs)
+
+            if self.alpha is None:
+                P = P.sum(axis=-2)
+            else:
+                a = self.alpha
+                weights = a*(1 - a)**np.arange(n_seg - 1, -1, -1)
+                P = np.einsum('k,...kf->...f', weights, P)
+                if self._acc is not None:
+                    self._acc = self._acc*(1 - a)**n_seg
+
+            self._acc = P if self._acc is None else self._acc + P
+            self.n_segments += n_seg
+
+        self._buf = buf[..., n_seg*self.step:].copy()
+
+
+    def psd(self):
+        """The current estimate.
+
+        Return: f [Hz] and the PSD [units**2/Hz] of shape (channels, freqs).
+            One sided for real data, two sided (fftshifted) for complex.
+            None, None before the first complete segment.
+        """
+
+        if self._acc is None:
+            return None, None
+
+        P = self._acc*self.scale
+        if self.alpha is None:
+            P = P/self.n_segments
+        else:
+            P = P/(1 - (1 - self.alpha)**self.n_segments) # startup bias
+
+        n = self.nperseg
+        if self.is_complex:
+            f = np.fft.fftshift(np.fft.fftfreq(n, 1/self.fs))
+            return f, np.fft.fftshift(P, axes=-1)
+
+        f = np.fft.rfftfreq(n, 1/self.fs)
+        P = P.copy()
+        last = -1 if n % 2 == 0 else None # no Nyquist bin to skip when odd
+        P[..., 1:last] *= 2 # fold negative frequencies in
+
+        return f, P
+
+
+
+# ============================================================================ #
+# GlitchDetector
+# ============================================================================ #
+
+
+# one detected glitch: a run of consecutive outlying samples in one channel,
+# located at its largest excursion from the median
+GLITCH_DTYPE = np.dtype([
+    ('channel',      '<i4'),
+    ('packet_count', '<i8'), # -1 if counts weren't given
+    ('t',            '<i8'), # PTP time [ns], -1 if t wasn't given
+    ('amplitude',    '<f8'), # excursion from the median (signed)
+    ('n_samples',    '<i4')]) # length of the run
+
+
+class GlitchDetector:
+    """Streaming glitch (e.g. cosmic ray) detector.
+
+    Each chunk is compared with the median and the MAD (median absolute
+    deviation) of the previous window samples of each channel, all
+    channels at once. Samples more than nsigma robust sigmas
+    (1.4826*MAD) from the median are outliers. Every run of consecutive
+    outliers in a channel becomes one GLITCH_DTYPE event record, which is
+    returned and handed to sink, e.g. a timestream_events.EventFile or
+    EventPublisher. Outliers enter the window as the median, so
+    a glitch doesn't inflate the threshold for what follows.
+    A run straddling two chunks is reported once in each.
+    """
+
+    def __init__(self, window=512, nsigma=6, sink=None):
+        """
+        window: (int) Samples of history per channel for the median and MAD.
+            Nothing is flagged until the window has filled.
+        nsigma: (float) Threshold in robust sigmas.
+        sink:   (callable) Called with each chunk's event records.
+        """
+
+        self.window = int(window)
+        self.nsigma = nsigma
+        self.sink   = sink
+        self.reset()
+
+
+    def reset(self):
+        """Forget the history."""
+
+        self._hist = None # (channels, window) ring of past samples
+        self._n = 0       # samples written to it
+        self.n_events = 0
+
+
+    def process(self, x, t=None, counts=None, channels=None):
+        """Check the next chunk for glitches.
+
+        x:        (2D array) Shape (channels, N), e.g. phase or df.
+        t:        (1D array of int) PTP times [ns] of the samples.
+        counts:   (1D array of int) Packet counts of the samples.
+        channels: (1D array of int) Channel number of each row
+            (default the row number).
+
+        Return: (1D structured array) GLITCH_DTYPE events, by channel.
+        """
+
+        x = np.asarray(x, dtype=float)
+        if x.ndim == 1:
+            x = x[None]
+        n_ch, N = x.shape
+
+        if self._hist is None:
+            self._hist = np.zeros((n_ch, self.window))
+
+        if self._n < self.window: # still filling
+            events = np.zeros(0, GLITCH_DTYPE)
+            self._store(x)
+            return events
+
+        med = np.median(self._hist, axis=1, keepdims=True)
+        mad = np.median(np.abs(self._hist - med), axis=1, keepdims=True)
+        dev = x - med
+        out = np.abs(dev) > self.nsigma*1.4826*mad
+        out &= mad > 0 # flat (e.g. unused) channels
+
+        events = self._events(dev, out, t, counts, channels)
+        self.n_events += len(events)
+
+        self._store(np.where(out, med, x))
+        if self.sink is not None:
+            self.sink(events)
+
+        return events
+
+
+    def _store(self, x):
+        """Write x into the history ring."""
+
+        N = x.shape[1]
+        if N >= self.window:
+            self._hist[:] = x[:, -self.window:]
+        else:
+            cols = (self._n + np.arange(N)) % self.window
+            self._hist[:, cols] = x
+        self._n += N
+
+
+    def _events(self, dev, out, t, counts, channels):
+        """One event per run of outliers in each row of out."""
+
+        n_ch, N = out.shape
+
+        # runs in the flattened rows, a False column keeping rows apart
+        m = np.zeros((n_ch, N + 1), bool)
+        m[:, :N] = out
+        m = m.ravel()
+        edges = np.flatnonzero(np.diff(m.view(np.int8), prepend=0))
+        starts, stops = edges[0::2], edges[1::2]
+
+        events = np.zeros(len(starts), GLITCH_DTYPE)
+        if not len(starts):
+            return events
+
+        # largest excursion of each run
+        d = np.zeros((n_ch, N + 1))
+        d[:, :N] = dev
+        d = d.ravel()
+        peak = np.array([i + np.argmax(np.abs(d[i:j])) for i, j in zip(starts, stops)])
+        row, col = np.divmod(peak, N + 1)
+
+        events['channel']      = row if channels is None else np.asarray(channels)[row]
+        events['packet_count'] = -1 if counts is None else np.asarray(counts)[col]
+        events['t']            = -1 if t is None else np.asarray(t)[col]
+        events['amplitude']    = d[peak]
+        events['n_samples']    = stops - starts
+
+        return events
+
+
+
+# ============================================================================ #
+# INTERNAL FUNCTIONS
+# ============================================================================ #
+
+
+# ============================================================================ #
+# _firTaps
+def _firTaps(factor, ntaps):
+    """Hamming windowed sinc low pass with its cutoff at the
+    Nyquist frequency of the decimated rate.
+    """
+
+    n = np.arange(ntaps) - (ntaps - 1)/2
+    h = np.sinc(n/factor) * np.hamming(ntaps)
+
+    return h
@@ -0,0 +1,89 @@
+# ============================================================================ #
+# timestream_events.py
+# Sinks for compact timestream event records, e.g. glitches.
+# James Burgoyne jburgoyne@phas.ubc.ca
+# CCAT Prime 2024
+# ============================================================================ #
+
+
+
+# ============================================================================ #
+# IMPORTS & GLOBALS
+# ============================================================================ #
+
+
+import pickle
+import numpy as np
+
+from timestream_writer import _NpyAppender
+
+
+# Event sinks are called with a structured array of new event records
+# (possibly empty, which they ignore).
+
+
+
+# ============================================================================ #
+# EventFile
+# ============================================================================ #
+
+
+class EventFile:
+    """Append event records to a growing .npy file.
+    The file is a valid .npy of every event so far after each call,
+    so np.load() it at any time.
+    """
+
+    def __init__(self, path, dtype):
+        """
+        path:  (str) File path, typically ending in .npy.
+        dtype: (numpy dtype) Event record dtype.
+        """
+
+        self.path = path
+        self._npy = _NpyAppender(path, dtype)
+
+
+    def __call__(self, events):
+        if len(events):
+            self._npy.append(events)
+
+
+    @property
+    def n(self):
+        """Events written."""
+
+        return self._npy.n
+
+
+    def close(self):
+        self._npy.close()
+
+
+
+# ============================================================================ #
+# EventPublisher
+# ============================================================================ #
+
+
+class EventPublisher:
+    """Publish event records on a Redis channel.
+    Each message is a pickled structured array of the new events,
+    the same pickled payloads the queen and drones exchange.
+    """
+
+    def __init__(self, r, channel):
+        """
+        r:       (redis.Redis) Connected client.
+        channel: (str) Channel to publish on, e.g. 'timestream_glitches'.
+        """
+
+        self.r = r
+        self.channel = channel
+        self.n = 0 # events published
+
+
+    def __call__(self, events):
+        if len(events):
+            self.r.publish(self.channel, pickle.dumps(np.asarray(events)))
+            self.n += len(events)
@@ -0,0 +1,239 @@
+# ============================================================================ #
+# timestream_merge.py
+# Align timestreams from several drones into combined frames.
+# James Burgoyne jburgoyne@phas.ubc.ca
+# CCAT Prime 2024
+# ============================================================================ #
+
+
+
+# ============================================================================ #
+# IMPORTS & GLOBALS
+# ============================================================================ #
+
+
+import numpy as np
+
+from timestream import N_CHANNELS
+
+
+PACKET_PERIOD_NS = 2_000_000 # 500 packets/s
+
+
+
+# ============================================================================ #
+# StreamMerger
+# ============================================================================ #
+
+
+class StreamMerger:
+    """Merge decoded per drone streams into aligned frames.
+
+    Every packet is given a slot: its packet count (key='count'), or its
+    PTP time on a grid of period_ns (key='time'). Each source has a fixed
+    circular buffer of depth slots that chunks are scattered into in one
+    vectorized step, and pop() gathers the completed slots of all sources
+    at once. A slot a source has no packet for is masked: its valid flag
+    is False and its t, I, and Q are NaN (t is -1).
+
+        merger = StreamMerger(['192.168.3.50', '192.168.3.51'], key='time')
+        merger.push('192.168.3.50', t, I, Q)
+        ...
+        frames = merger.pop()
+
+    Memory is fixed: a source more than depth slots ahead of the oldest
+    unemitted slot pushes the oldest slots out (their packets, and those
+    of the push itself that fall before the new oldest slot, are counted
+    in overrun), and packets for slots already emitted are dropped
+    (counted in late).
+    """
+
+    def __init__(self, sources, key='time', period_ns=PACKET_PERIOD_NS,
+                 tolerance_ns=None, depth=1024, latency=256,
+                 n_channels=N_CHANNELS, dtype=np.float32):
+        """
+        sources:      (list) Source names, e.g. drone IPs; frames have
+            one row per source in this order.
+        key:          (str) {'time', 'count'} Align on PTP time or packet count.
+            Packet counts only line up across boards that reset them together.
+        period_ns:    (int) Packet period [ns] (time key).
+        tolerance_ns: (int) Largest distance from the time grid to accept
+            a packet at (time key), default period_ns/2 (nearest slot).
+        depth:        (int) Slots buffered per source.
+        latency:      (int) pop() waits for a late source up to this many
+            slots behind the furthest one, then masks its packets.
+        n_channels:   (int) Channels per packet (rows of the I and Q pushed).
+        dtype:        (numpy dtype) I and Q buffer type (floating, for the NaNs).
+        """
+
+        if key not in ('time', 'count'):
+            raise ValueError(f"Unknown merge key: {key}")
+
+        self.sources    = list(sources)
+        self.key        = key
+        self.period_ns  = int(period_ns)
+        self.tolerance_ns = self.period_ns//2 if tolerance_ns is None else tolerance_ns
+        self.depth      = int(depth)
+        self.latency    = min(int(latency), self.depth)
+        self.n_channels = int(n_channels)
+        self.dtype      = dtype
+
+        self._index = {src: i for i, src in enumerate(self.sources)}
+        n_src = len(self.sources)
+        self._I     = np.zeros((n_src, self.n_channels, self.depth), dtype)
+        self._Q     = np.zeros((n_src, self.n_channels, self.depth), dtype)
+        self._t     = np.zeros((n_src, self.depth), np.int64)
+        self._valid = np.zeros((n_src, self.depth), bool)
+        self._top   = np.zeros(n_src, np.int64) # highest slot pushed + 1, 0 for none
+        self._count = [None]*n_src # last unwrapped packet count
+
+        self.t_ref = None # PTP time of slot 0 (time key)
+        self.next_slot = None # oldest slot not emitted yet
+
+        self.late       = 0 # packets for slots already emitted
+        self.overrun    = 0 # packets pushed out before they were emitted
+        self.off_grid   = 0 # packets too far from the time grid
+
+
+    def push(self, source, t, I, Q, counts=None):
+        """Add a decoded chunk from one source.
+
+        source: Name from sources.
+        t:      (1D array of int) PTP times [ns].
+        I, Q:   (2D arrays) Shape (n_channels, N).
+        counts: (1D array of int) Packet counts (count key only).
+        """
+
+        s = self._index[source]
+        t = np.asarray(t, dtype=np.int64)
+        if len(t) == 0:
+            return
+
+        slots, keep = self._slots(s, t, counts)
+        if self.next_slot is None:
+            self.next_slot = int(slots[keep].min()) if keep.any() else None
+            if self.next_slot is None:
+                return
+
+        # slots already emitted
+        old = keep & (slots < self.next_slot)
+        self.late += int(np.count_nonzero(old))
+        keep &= ~old
+
+        if not keep.any():
+            return
+        slots = slots[keep]
+
+        # make room: the buffer only spans depth slots
+        top = int(slots.max()) + 1
+        if top - self.next_slot > self.depth:
+            self._evict(top - self.depth)
+            ok = slots >= self.next_slot
+            self.overrun += int(len(ok) - np.count_nonzero(ok))
+            slots, keep = slots[ok], np.flatnonzero(keep)[ok]
+
+        cols = slots % self.depth
+        self._I[s][:, cols] = I[:, keep]
+        self._Q[s][:, cols] = Q[:, keep]
+        self._t[s, cols] = t[keep]
+        self._valid[s, cols] = True
+        self._top[s] = max(self._top[s], top)
+
+
+    def pushFrames(self, source, frames):
+        """Add FRAME_DTYPE frames (see packetsToFrames()) from one source."""
+
+        iq = frames['iq']
+        self.push(source, frames['t'], iq[:, :, 0].T, iq[:, :, 1].T,
+                  frames['packet_count'])
+
+
+    def pop(self, flush=False):
+        """Emit the slots every source has moved past, plus those a late
+        source is more than latency slots behind on.
+        flush: (bool) Emit everything buffered.
+
+        Return: dict of
+            slot:  (1D array) Slot numbers (unwrapped packet counts for the
+                count key, periods since t_ref for the time key).
+            valid: (2D array of bool) (sources, M), False where masked.
+            t:     (2D array of int) (sources, M) PTP times [ns], -1 if masked.
+            I, Q:  (3D arrays) (sources, n_channels, M), NaN if masked.
+            None if there is nothing to emit.
+        """
+
+        if self.next_slot is None:
+            return None
+
+        pushed = self._top > 0
+        if not pushed.any():
+            return None
+
+        furthest = int(self._top[pushed].max())
+        if flush:
+            stop = furthest
+        else:
+            stop = max(int(self._top.min()), furthest - self.latency)
+
+        if stop <= self.next_slot:
+            return None
+
+        return self._take(stop)
+
+
+    # ======================================================================== #
+    # internal
+
+    def _slots(self, s, t, counts):
+        """Slot of each packet of source s, and which to keep."""
+
+        if self.key == 'count':
+            if counts is None:
+                raise ValueError("Aligning on packet count needs the counts.")
+            c = np.asarray(counts, dtype=np.int64)
+            ref = c[0] - 1 if self._count[s] is None else self._count[s]
+            steps = np.diff(c, prepend=ref % 2**32)
+            steps = (steps + 2**31) % 2**32 - 2**31 # unwrap 32 bit counts
+            slots = ref + np.cumsum(steps)
+            self._count[s] = int(slots[-1])
+            return slots, np.ones(len(slots), bool)
+
+        if self.t_ref is None:
+            self.t_ref = int(t[0])
+        d = t - self.t_ref
+        slots = np.floor_divide(d + self.period_ns//2, self.period_ns)
+        keep = np.abs(d - slots*self.period_ns) <= self.tolerance_ns
+        self.off_grid += int(np.count_nonzero(~keep))
+
+        return slots, keep
+
+
+    def _take(self, stop):
+        """Gather and clear slots next_slot to stop-1 of every source."""
+
+        slots = np.arange(self.next_slot, stop)
+        cols = slots % self.depth
+
+        valid = self._valid[:, cols]
+        t = np.where(valid, self._t[:, cols], -1)
+        mask = ~valid[:, None, :]
+        I = self._I[:, :, cols]
+        Q = self._Q[:, :, cols]
+        if mask.any(): # I and Q are copies already (fancy indexing)
+            I[np.broadcast_to(mask, I.shape)] = np.nan
+            Q[np.broadcast_to(mask, Q.shape)] = np.nan
+
+        self._valid[:, cols] = False
+        self.next_slot = stop
+
+        return {'slot': slots, 'valid': valid, 't': t, 'I': I, 'Q': Q}
+
+
+    def _evict(self, new_start):
+        """Drop slots before new_start that weren't emitted."""
+
+        n = min(new_start, self.next_slot + self.depth) - self.next_slot
+        cols = np.arange(self.next_slot, self.next_slot + n) % self.depth
+        self.overrun += int(np.count_nonzero(self._valid[:, cols]))
+        self._valid[:, cols] = False
+        self.next_slot = new_start
@@ -0,0 +1,350 @@
+# ============================================================================ #
+# timestream_shm.py
+# Shared memory timestream ring: one capture process, many local readers.
+# James Burgoyne jburgoyne@phas.ubc.ca
+# CCAT Prime 2024
+# ============================================================================ #
+
+
+
+# ============================================================================ #
+# IMPORTS & GLOBALS
+# ============================================================================ #
+
+
+import socket
+import time
+import numpy as np
+from multiprocessing import shared_memory
+
+from timestream import TimeStream, PacketRing, PACKET_BYTES, RING_SIZE, decodeChunk
+
+
+MAX_SOURCES = 64 # source IPs the shared ring can register
+
+# shared block layout: header, then per row arrays, then the packets
+_HEADER = 8   # int64: count, size, packet_bytes, n_sources, unused...
+_ALIGN  = 64
+
+
+
+# ============================================================================ #
+# SharedPacketRing
+# ============================================================================ #
+
+
+class SharedPacketRing(PacketRing):
+    """A PacketRing living in a multiprocessing.shared_memory block.
+
+    The capture process creates it and hands it to TimeStream(ring=...),
+    so packets are received straight into shared memory.
+    Any number of local processes attach to it by name and read
+    the packets in place (decodePackets() views them without a copy).
+
+    There are no locks. Each row carries the packet number it holds,
+    set to -1 while the row is being written, and the count in the header
+    is only advanced once a row is complete. Readers check the row numbers
+    after reading to catch rows the writer overtook.
+    """
+
+    def __init__(self, name, size=None, packet_bytes=PACKET_BYTES, create=False):
+        """
+        name:         (str) Shared memory block name.
+        size:         (int) Packets in the ring (create only).
+        packet_bytes: (int) Bytes per row (create only).
+        create:       (bool) Create the block (capture process)
+            instead of attaching to an existing one (readers).
+        """
+
+        self.name = name
+        self.creator = create
+
+        if create:
+            size = RING_SIZE if size is None else int(size)
+            nbytes = _layout(size, packet_bytes)['total']
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=nbytes)
+            header = np.ndarray(_HEADER, dtype=np.int64, buffer=self.shm.buf)
+            header[:] = 0
+            header[1], header[2] = size, packet_bytes
+
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            _untrack(self.shm) # the creator owns the block's lifetime
+            header = np.ndarray(_HEADER, dtype=np.int64, buffer=self.shm.buf)
+            size, packet_bytes = int(header[1]), int(header[2])
+
+        self.size         = size
+        self.packet_bytes = packet_bytes
+        self._header      = header
+
+        lay, buf = _layout(size, packet_bytes), self.shm.buf
+        self.seqs    = np.ndarray(size, np.int64, buf, lay['seqs'])
+        self.lengths = np.ndarray(size, np.int32, buf, lay['lengths'])
+        self.sources = np.ndarray(size, np.int16, buf, lay['sources'])
+        self._ips    = np.ndarray(MAX_SOURCES, np.uint32, buf, lay['ips'])
+        self.packets = np.ndarray((size, packet_bytes), np.uint8, buf, lay['packets'])
+
+        if create:
+            self.seqs[:] = -1
+
+        self._slots = [memoryview(row) for row in self.packets]
+        self.source_ids = {}
+
+
+    # count lives in the shared header so readers see the writer's progress
+    @property
+    def count(self):
+        return int(self._header[0])
+
+    @count.setter
+    def count(self, value):
+        self._header[0] = value
+
+
+    @property
+    def source_addrs(self):
+        """Registered source IPs by id."""
+
+        ips = self._ips[:int(self._header[3])]
+        return [socket.inet_ntoa(int(ip).to_bytes(4, 'big')) for ip in ips]
+
+
+    def sourceId(self, addr):
+        """Small integer id of source IP addr, registered on first sight."""
+
+        sid = self.source_ids.get(addr)
+        if sid is None:
+            n = int(self._header[3])
+            if n >= MAX_SOURCES:
+                raise ValueError(f"More than {MAX_SOURCES} timestream sources.")
+            self._ips[n] = int.from_bytes(socket.inet_aton(addr), 'big')
+            self._header[3] = n + 1
+            sid = self.source_ids[addr] = n
+        return sid
+
+
+    def nextSlot(self):
+        """Writable memoryview of the next row, marked as being written."""
+
+        i = self.count % self.size
+        self.seqs[i] = -1
+        return self._slots[i]
+
+
+    def commit(self, nbytes, source=0):
+        """Mark the next row as filled with nbytes of packet."""
+
+        count = self.count
+        i = count % self.size
+        self.lengths[i] = nbytes
+        self.sources[i] = source
+        self.seqs[i] = count
+        self.count = count + 1
+
+
+    def intact(self, start, stop):
+        """Boolean mask of which of packets start to stop-1 are
+        still in their rows. Check after reading a view.
+        """
+
+        return self.seqs[self.slots(start, stop)] == np.arange(start, stop)
+
+
+    def read(self, start, stop):
+        """Copy of packets start to stop-1 that the writer didn't overtake.
+        Returns the packets and the packet number after the last one.
+        """
+
+        count = self.count # the writer moves on while we copy
+        start = max(start, count - self.size + 1, 0)
+        stop  = max(min(stop, count), start)
+        x = np.array(self._slice(self.packets, start, stop)) # copy
+
+        # the writer only overtakes from the front, so keep the tail
+        ok = self.intact(start, stop)
+        first = len(ok) - np.argmin(ok[::-1]) if not ok.all() else 0
+        return x[first:], stop
+
+
+    def close(self):
+        """Detach from the block, and remove it if this is the creator."""
+
+        self.seqs = self.lengths = self.sources = self.packets = None
+        self._ips = self._header = None
+        self._slots = []
+        self.shm.close()
+        if self.creator:
+            self.shm.unlink()
+
+
+
+# ============================================================================ #
+# SharedTimeStream
+# ============================================================================ #
+
+
+class SharedTimeStream:
+    """Timestream reader attached to a SharedPacketRing.
+    Mirrors the TimeStream read methods.
+    """
+
+    def __init__(self, name):
+        """
+        name: (str) Shared memory block name given to the publisher.
+        """
+
+        self.ring = SharedPacketRing(name)
+        self._cursor = self.ring.count
+
+
+    def getTimeStreamChunk(self, N, return_time=False, channels=None, dtype=float,
+                           poll=0.001):
+        """The next N packets after the previous chunk,
+        polling every poll seconds until they are published.
+        Returns I and Q, or t, I, and Q if return_time.
+        channels: Only decode these channels, see unpackIQ().
+        dtype:    I and Q type, see decodeChunk().
+        """
+
+        ring = self.ring
+        start = max(self._cursor, ring.count - ring.size + 1)
+        while ring.count < start + N:
+            time.sleep(poll)
+
+        x, self._cursor = ring.read(start, start + N)
+
+        return decodeChunk(x, return_time, channels, dtype)
+
+
+    def getLatest(self, N, return_time=False, channels=None, dtype=float):
+        """The latest N packets (or fewer) already published.
+        Arguments as getTimeStreamChunk().
+        """
+
+        count = self.ring.count
+        x, _ = self.ring.read(count - N, count)
+
+        return decodeChunk(x, return_time, channels, dtype)
+
+
+    def getRawSince(self, cursor):
+        """All raw packets published since cursor, see TimeStream.getRawSince().
+        Return: cursor, and a (N, PACKET_BYTES) uint8 copy of the packets.
+        """
+
+        count = self.ring.count
+        if cursor is None:
+            cursor = count
+
+        x, cursor = self.ring.read(cursor, count)
+
+        return cursor, x
+
+
+    def getSince(self, cursor, return_time=False, channels=None, dtype=float):
+        """All packets published since cursor, see TimeStream.getSince().
+        Return: cursor, then I and Q, or t, I, and Q if return_time.
+        channels: Only decode these channels, see unpackIQ().
+        dtype:    I and Q type, see decodeChunk().
+        """
+
+        cursor, x = self.getRawSince(cursor)
+
+        return (cursor, *decodeChunk(x, return_time, channels, dtype))
+
+
+    def close(self):
+        self.ring.close()
+
+
+
+# ============================================================================ #
+# publish
+def publish(host, port, name, size=RING_SIZE, report=10):
+    """Capture a timestream into a shared memory ring until interrupted.
+
+    host:   (str) IP address to bind to.
+    port:   (int) UDP port to bind to.
+    name:   (str) Shared memory block name for readers to attach to.
+    size:   (int) Packets in the ring.
+    report: (float) Print the packet stats every this many seconds.
+    """
+
+    ring = SharedPacketRing(name, size, create=True)
+    timestream = TimeStream(host, port, ring=ring)
+    timestream.startCapture()
+    print(f"Publishing {host}:{port} to shared memory '{name}'...")
+
+    try:
+        while True:
+            time.sleep(report)
+            for addr, stats in timestream.stats.items():
+                print(f"   {addr}: {stats}")
+            print(f"   socket: {timestream.sock_stats}")
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        timestream.stopCapture()
+        ring.close()
+
+
+
+# ============================================================================ #
+# INTERNAL FUNCTIONS
+# ============================================================================ #
+
+
+# ============================================================================ #
+# _layout
+def _layout(size, packet_bytes):
+    """Byte offsets of the arrays in the shared block."""
+
+    def align(n):
+        return -(-n // _ALIGN) * _ALIGN
+
+    lay = {}
+    off = align(8*_HEADER)
+    for key, nbytes in (
+            ('seqs',    8*size),
+            ('lengths', 4*size),
+            ('sources', 2*size),
+            ('ips',     4*MAX_SOURCES),
+            ('packets', size*packet_bytes)):
+        lay[key] = off
+        off = align(off + nbytes)
+    lay['total'] = off
+
+    return lay
+
+
+# ============================================================================ #
+# _untrack
+def _untrack(shm):
+    """Stop this process' resource tracker from unlinking an attached block
+    on exit (it would pull the ring out from under the other processes).
+    """
+
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+
+
+
+# ============================================================================ #
+# __main__
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Publish a UDP timestream to a shared memory ring.")
+    parser.add_argument('--host', default='192.168.3.40')
+    parser.add_argument('--port', type=int, default=4096)
+    parser.add_argument('--name', default='timestream')
+    parser.add_argument('--size', type=int, default=RING_SIZE)
+    args = parser.parse_args()
+
+    publish(args.host, args.port, args.name, args.size)
@@ -0,0 +1,279 @@
+# ============================================================================ #
+# timestream_sim.py
+# Synthetic RFSoC timestream packets and a loopback capture benchmark.
+# James Burgoyne jburgoyne@phas.ubc.ca
+# CCAT Prime 2024
+# ============================================================================ #
+
+
+
+# ============================================================================ #
+# IMPORTS & GLOBALS
+# ============================================================================ #
+
+
+import socket
+import time
+import numpy as np
+
+from timestream import (
+    TimeStream, PACKET_BYTES, N_CHANNELS, RING_SIZE, RCVBUF_BYTES,
+    decodePackets)
+
+
+NS = 1_000_000_000
+
+
+
+# ============================================================================ #
+# makePackets
+def makePackets(counts, t, I, Q, packet_info=0, I_1022=0):
+    """Byte exact UDP payloads (see docs/rfsoc_datagram.csv).
+
+    counts:      (1D array of int) Packet counts (wrapped to 32 bits).
+    t:           (1D array of int) PTP time of day [ns].
+    I, Q:        (2D arrays of int) Shape (N_CHANNELS, N) channel I and Q.
+    packet_info: (int or 1D array) Low 32 bits of the packet info field.
+    I_1022:      (int or 1D array) The lone channel 1022 I.
+
+    Return: (2D array of uint8) Packets of shape (N, PACKET_BYTES).
+    """
+
+    n = len(counts)
+    packets = np.zeros((n, PACKET_BYTES), dtype=np.uint8)
+    x = decodePackets(packets)
+
+    t = np.asarray(t, dtype=np.int64)
+    sec, ns = np.divmod(t, NS)
+
+    x['iq'][:, :, 0] = np.asarray(I).T
+    x['iq'][:, :, 1] = np.asarray(Q).T
+    x['i_1022']       = I_1022
+    x['packet_info']  = packet_info
+    x['packet_count'] = np.asarray(counts, dtype=np.int64) % 2**32
+    x['ptp_sec_hi']   = sec >> 32
+    x['ptp_sec_lo']   = sec & 0xFFFFFFFF
+    x['ptp_ns']       = ns
+
+    return packets
+
+
+
+# ============================================================================ #
+# PacketGenerator
+# ============================================================================ #
+
+
+class PacketGenerator:
+    """Synthetic drone timestream sent over UDP.
+
+    Each channel carries a tone: I + jQ = amp*exp(j(2 pi f_mod t + phase))
+    plus gaussian noise, in int32 counts. Packet counts increment and the
+    PTP time advances at the packet rate. Drops skip a packet (its count
+    is still used) and reordering swaps a packet with the next one.
+    """
+
+    def __init__(self, host='127.0.0.1', port=4096, rate=500,
+                 amp=1e6, f_mod=0, noise=0, drop=0, reorder=0,
+                 packet_info=0, count0=0, t0=None, block=64, seed=None):
+        """
+        host:        (str) Destination IP.
+        port:        (int) Destination UDP port.
+        rate:        (float) Packets per second, or None for as fast as possible.
+        amp:         (float or 1D array) Tone amplitude per channel [counts].
+        f_mod:       (float or 1D array) Tone phase rotation rate per channel [Hz].
+        noise:       (float) Gaussian noise sigma in I and Q [counts].
+        drop:        (float) Probability of dropping each packet.
+        reorder:     (float) Probability of swapping a packet with the next.
+        packet_info: (int) Packet info field value.
+        count0:      (int) First packet count (e.g. near 2**32 to test wraps).
+        t0:          (int) First PTP time [ns], default now.
+        block:       (int) Packets generated per vectorized batch.
+        seed:        (int) Random seed.
+        """
+
+        self.addr = (host, port)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        self.rate    = rate
+        self.amp     = np.broadcast_to(np.asarray(amp, dtype=float), N_CHANNELS)[:, None]
+        self.f_mod   = np.broadcast_to(np.asarray(f_mod, dtype=float), N_CHANNELS)[:, None]
+        self.noise   = noise
+        self.drop    = drop
+        self.reorder = reorder
+        self.packet_info = packet_info
+        self.block   = block
+
+        self.rng = np.random.default_rng(seed)
+        self.phase = self.rng.uniform(0, 2*np.pi, (N_CHANNELS, 1))
+        self.dt = NS//int(rate) if rate else NS//500 # PTP step per packet
+
+        self.count = count0 # next packet count
+        self.t = time.time_ns() if t0 is None else t0 # next PTP time
+        self.sent    = 0 # packets sent
+        self.dropped = 0 # packets dropped on purpose
+
+
+    def packets(self, n):
+        """The next n packets, before drops and reordering.
+        Return: (2D array of uint8) Shape (n, PACKET_BYTES).
+        """
+
+        counts = self.count + np.arange(n)
+        t = self.t + self.dt*np.arange(n)
+        self.count += n
+        self.t += self.dt*n
+
+        z = self.amp*np.exp(1j*(2*np.pi*self.f_mod*(t/NS) + self.phase))
+        if self.noise:
+            z = z + self.noise*(self.rng.standard_normal(z.shape)
+                                + 1j*self.rng.standard_normal(z.shape))
+
+        return makePackets(counts, t,
+            np.rint(z.real).astype(np.int32), np.rint(z.imag).astype(np.int32),
+            self.packet_info)
+
+
+    def _order(self, n):
+        """Send order of a block of n packets: drops removed, swaps applied."""
+
+        order = np.arange(n)
+        if self.reorder:
+            swap = np.flatnonzero(self.rng.random(n - 1) < self.reorder)
+            swap = swap[np.diff(swap, prepend=-2) > 1] # no overlapping swaps
+            order[swap], order[swap + 1] = order[swap + 1], order[swap]
+        if self.drop:
+            order = order[self.rng.random(n) >= self.drop]
+
+        return order
+
+
+    def send(self, n):
+        """Generate and send n packets, paced at the packet rate."""
+
+        sock, addr = self.sock, self.addr
+        period = 1/self.rate if self.rate else 0
+        start, i = time.perf_counter(), 0
+
+        while n > 0:
+            k = min(n, self.block)
+            packets = self.packets(k)
+            order = self._order(k)
+            self.dropped += k - len(order)
+
+            for j in order:
+                if period:
+                    wait = start + i*period - time.perf_counter()
+                    if wait > 0:
+                        time.sleep(wait)
+                sock.sendto(packets[j], addr)
+                i += 1
+            self.sent += len(order)
+            n -= k
+
+
+    def run(self, duration):
+        """Send at the packet rate for duration seconds (rate must be set)."""
+
+        self.send(int(duration*self.rate))
+
+
+    def close(self):
+        self.sock.close()
+
+
+
+# ============================================================================ #
+# benchmark
+def benchmark(rate=None, duration=5, port=4096, ring_size=None,
+              rcvbuf=RCVBUF_BYTES, **kwargs):
+    """Loopback capture benchmark: a PacketGenerator in another process
+    sends to a background capturing TimeStream in this one.
+
+    rate:      (float) Packets per second, None for as fast as possible.
+    duration:  (float) Seconds to send for (approximately, if rate is None).
+    port:      (int) Loopback UDP port.
+    ring_size: (int) Capture ring size (default RING_SIZE).
+    rcvbuf:    (int) Socket receive buffer target [bytes].
+    kwargs:    Passed to PacketGenerator (e.g. drop, reorder).
+
+    Return: (dict) sent and received packets, sustained packets/s,
+        capture CPU time per packet [us], packets lost between the
+        generator and the ring, the capture PacketStats, and the
+        SocketStats (kernel drops).
+    """
+
+    import multiprocessing as mp
+
+    timestream = TimeStream('127.0.0.1', port, rcvbuf=rcvbuf)
+    timestream.startCapture(ring_size or RING_SIZE)
+
+    n = int(duration*(rate or 200_000))
+    sent = mp.Value('q', 0)
+    proc = mp.Process(target=_benchSend, args=(port, rate, n, sent, kwargs))
+
+    cpu0, wall0 = time.process_time(), time.perf_counter()
+    proc.start()
+    proc.join()
+    wall = time.perf_counter() - wall0
+    time.sleep(0.2) # let the capture drain the socket
+    timestream.stopCapture()
+    cpu = time.process_time() - cpu0
+
+    received = timestream.ring.count
+    stats = next(iter(timestream.stats.values()), None)
+    timestream.sock_stats.sample()
+    timestream.sock.close()
+
+    return {
+        'sent':           sent.value,
+        'received':       received,
+        'packets_per_s':  received/wall,
+        'cpu_us_per_packet': 1e6*cpu/max(received, 1),
+        'lost_in_transit':   sent.value - received,
+        'stats':          stats,
+        'socket':         timestream.sock_stats}
+
+
+def _benchSend(port, rate, n, sent, kwargs):
+    """benchmark() generator process."""
+
+    gen = PacketGenerator(port=port, rate=rate, **kwargs)
+    gen.send(n)
+    sent.value = gen.sent
+    gen.close()
+
+
+
+# ============================================================================ #
+# __main__
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Send a synthetic RFSoC timestream, or benchmark loopback capture.")
+    parser.add_argument('mode', choices=['send', 'bench'])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=4096)
+    parser.add_argument('--rate', type=float, default=500,
+        help="packets/s, 0 for as fast as possible")
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--drop', type=float, default=0)
+    parser.add_argument('--reorder', type=float, default=0)
+    parser.add_argument('--noise', type=float, default=0)
+    parser.add_argument('--rcvbuf', type=int, default=RCVBUF_BYTES,
+        help="bench socket receive buffer target [bytes]")
+    args = parser.parse_args()
+
+    rate = args.rate or None
+    opts = dict(drop=args.drop, reorder=args.reorder, noise=args.noise)
+
+    if args.mode == 'send':
+        gen = PacketGenerator(args.host, args.port, rate, **opts)
+        gen.send(int(args.duration*(rate or 200_000)))
+        print(f"Sent {gen.sent} packets ({gen.dropped} dropped on purpose).")
+
+    else:
+        res = benchmark(rate, args.duration, args.port, rcvbuf=args.rcvbuf, **opts)
+        for k, v in res.items():
+            print(f"{k}: {v:.2f}" if isinstance(v, float) else f"{k}: {v}")
@@ -0,0 +1,500 @@
+# ============================================================================ #
+# timestream_writer.py
+# Stream timestream data to disk in constant memory.
+# James Burgoyne jburgoyne@phas.ubc.ca
+# CCAT Prime 2024
+# ============================================================================ #
+
+
+
+# ============================================================================ #
+# IMPORTS & GLOBALS
+# ============================================================================ #
+
+
+import os
+import glob
+import json
+import struct
+import threading
+import numpy as np
+from datetime import datetime
+from pathlib import Path
+
+from timestream import FRAME_DTYPE, N_CHANNELS, packetsToFrames, decodePackets, ptpToNs
+
+
+CHUNK_FRAMES = 512      # frames decoded and appended per write
+FILE_FRAMES  = 2**17    # frames per file before rotating (~1 GB)
+BLOCK_FRAMES = 2048     # frames per detector-major archive block (~16 MB)
+
+# time-major columns kept alongside a detector-major archive
+ARCHIVE_FRAME_DTYPE = np.dtype([
+    ('t',            '<i8'),
+    ('packet_count', '<u4'),
+    ('packet_info',  '<u4')])
+
+# one entry per archive block
+ARCHIVE_INDEX_DTYPE = np.dtype([
+    ('first', '<i8'), # number of the block's first frame
+    ('n',     '<i8'), # frames in the block
+    ('t0',    '<i8'), # PTP time of the first frame [ns]
+    ('t1',    '<i8')]) # PTP time of the last frame [ns]
+
+
+
+# ============================================================================ #
+# TimeStreamWriter
+# ============================================================================ #
+
+
+class TimeStreamWriter:
+    """Append decoded timestream frames to rotating .npy files.
+
+    Each file is a 1D .npy array of FRAME_DTYPE that only ever grows
+    at the end, so np.load(..., mmap_mode='r') opens it without reading
+    it into memory, even while it is still being written.
+    Frames are decoded into one preallocated chunk buffer and appended
+    chunk by chunk, so memory use and time per chunk stay constant
+    however long the capture runs.
+    """
+
+    def __init__(self, dname='tmp', fname='timestream',
+                 chunk_frames=CHUNK_FRAMES, file_frames=FILE_FRAMES):
+        """
+        dname:        (str) Directory to write to (created if needed).
+        fname:        (str) Base filename; files are named
+            [fname]_[timestamp]_[file number].npy
+        chunk_frames: (int) Frames per appended chunk.
+        file_frames:  (int) Frames per file before rotating to a new file.
+        """
+
+        self.dname        = dname
+        self.fname        = fname
+        self.chunk_frames = int(chunk_frames)
+        self.file_frames  = int(file_frames)
+        self.timestamp    = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+
+        self.files          = [] # paths written so far
+        self.frames_written = 0
+        self.bytes_written  = 0
+
+        self._chunk = np.empty(self.chunk_frames, dtype=FRAME_DTYPE)
+        self._n_chunk = 0 # frames waiting in the chunk buffer
+        self._f = None    # current file
+
+        Path(dname).mkdir(parents=True, exist_ok=True)
+
+
+    def write(self, packets):
+        """Decode raw packets and append them.
+        packets: (2D array of uint8) Raw packets, shape (N, PACKET_BYTES).
+        """
+
+        i = 0
+        while i < len(packets):
+            n = self._n_chunk
+            part = packets[i:i + self.chunk_frames - n]
+            packetsToFrames(part, out=self._chunk[n:])
+            self._n_chunk += len(part)
+            i += len(part)
+
+            if self._n_chunk == self.chunk_frames:
+                self.flush()
+
+
+    def writeFrames(self, frames):
+        """Append already decoded FRAME_DTYPE frames."""
+
+        self.flush()
+        self._append(np.ascontiguousarray(frames, dtype=FRAME_DTYPE))
+
+
+    def flush(self):
+        """Append the frames waiting in the chunk buffer."""
+
+        if self._n_chunk:
+            self._append(self._chunk[:self._n_chunk])
+            self._n_chunk = 0
+
+
+    def close(self):
+        """Flush and close the current file."""
+
+        self.flush()
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+
+    def _append(self, frames):
+        """Append frames to the files, rotating when a file is full."""
+
+        while len(frames):
+            if self._f is None or self._f.n >= self.file_frames:
+                self._rotate()
+
+            part = frames[:self.file_frames - self._f.n]
+            self._f.append(part)
+            self.frames_written += len(part)
+            self.bytes_written += part.nbytes
+            frames = frames[len(part):]
+
+
+    def _rotate(self):
+        """Close the current file and start the next."""
+
+        if self._f is not None:
+            self._f.close()
+
+        path = f'{self.dname}/{self.fname}_{self.timestamp}_{len(self.files):04d}.npy'
+        self._f = _NpyAppender(path, FRAME_DTYPE)
+        self.files.append(path)
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+# ============================================================================ #
+# TimeStreamArchiveWriter
+# ============================================================================ #
+
+
+class TimeStreamArchiveWriter:
+    """Write a detector-major timestream archive.
+
+    Packets arrive time-major (all channels per packet), but analysis
+    mostly reads one detector over a long time. Frames are collected in a
+    preallocated (N_CHANNELS, 2, block_frames) block, transposed in as
+    they arrive, and each full block is appended to iq.dat. Within a block
+    the I and Q of one channel are contiguous, so reading one detector
+    touches 8*block_frames bytes per block instead of the whole block.
+
+    An archive is a directory holding:
+        iq.dat:       int32 blocks of shape (N_CHANNELS, 2, block_frames).
+        frames.npy:   ARCHIVE_FRAME_DTYPE time-major columns, one per frame.
+        index.npy:    ARCHIVE_INDEX_DTYPE, one entry per block.
+        archive.json: Block geometry.
+    Read it with TimeStreamArchive.
+    """
+
+    def __init__(self, dname, block_frames=BLOCK_FRAMES):
+        """
+        dname:        (str) Archive directory (created, must not hold an archive).
+        block_frames: (int) Frames per block.
+        """
+
+        self.dname        = dname
+        self.block_frames = int(block_frames)
+
+        self.frames_written = 0
+        self.bytes_written  = 0
+
+        Path(dname).mkdir(parents=True, exist_ok=True)
+        with open(f'{dname}/archive.json', 'x') as f:
+            json.dump({
+                'block_frames': self.block_frames,
+                'n_channels':   N_CHANNELS,
+                'dtype':        '<i4'}, f)
+
+        self._block = np.zeros((N_CHANNELS, 2, self.block_frames), dtype='<i4')
+        self._meta = np.zeros(self.block_frames, dtype=ARCHIVE_FRAME_DTYPE)
+        self._n = 0 # frames in the current block
+
+        self._iq     = open(f'{dname}/iq.dat', 'wb')
+        self._frames = _NpyAppender(f'{dname}/frames.npy', ARCHIVE_FRAME_DTYPE)
+        self._index  = _NpyAppender(f'{dname}/index.npy', ARCHIVE_INDEX_DTYPE)
+
+
+    def write(self, packets):
+        """Decode raw packets and add them to the archive.
+        packets: (2D array of uint8) Raw packets, shape (N, PACKET_BYTES).
+        """
+
+        x = decodePackets(packets)
+
+        i = 0
+        while i < len(x):
+            n = self._n
+            part = x[i:i + self.block_frames - n]
+            m = len(part)
+
+            # time-major (m, channels, 2) -> detector-major (channels, 2, m)
+            self._block[:, :, n:n+m] = part['iq'].transpose(1, 2, 0)
+            self._meta['t'][n:n+m]            = ptpToNs(part)
+            self._meta['packet_count'][n:n+m] = part['packet_count']
+            self._meta['packet_info'][n:n+m]  = part['packet_info']
+
+            self._n += m
+            i += m
+            if self._n == self.block_frames:
+                self.flush()
+
+
+    def flush(self):
+        """Write out the current block, even if it is only partly full.
+        Every block takes the full size on disk; the index holds its length.
+        """
+
+        n = self._n
+        if n == 0:
+            return
+
+        self._block[:, :, n:] = 0
+        self._iq.write(self._block)
+        self._iq.flush()
+        self._frames.append(self._meta[:n])
+
+        entry = np.zeros(1, dtype=ARCHIVE_INDEX_DTYPE)
+        entry['first'] = self.frames_written
+        entry['n']     = n
+        entry['t0']    = self._meta['t'][0]
+        entry['t1']    = self._meta['t'][n-1]
+        self._index.append(entry)
+
+        self.frames_written += n
+        self.bytes_written  += self._block.nbytes
+        self._n = 0
+
+
+    def close(self):
+        self.flush()
+        self._iq.close()
+        self._frames.close()
+        self._index.close()
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+# ============================================================================ #
+# TimeStreamArchive
+# ============================================================================ #
+
+
+class TimeStreamArchive:
+    """Read a detector-major archive written by TimeStreamArchiveWriter.
+    Everything is memory mapped; only the blocks of the requested
+    channel and time range are read from disk.
+    """
+
+    def __init__(self, dname):
+        """
+        dname: (str) Archive directory.
+        """
+
+        self.dname = dname
+        with open(f'{dname}/archive.json') as f:
+            meta = json.load(f)
+        self.block_frames = meta['block_frames']
+        self.n_channels   = meta['n_channels']
+
+        self.index  = np.load(f'{dname}/index.npy')
+        self.frames = np.load(f'{dname}/frames.npy', mmap_mode='r')
+        self.n_frames = int(self.index['n'].sum())
+        self.frames = self.frames[:self.n_frames] # in case of a block mid write
+
+        n_blocks = len(self.index)
+        self.iq = np.memmap(
+            f'{dname}/iq.dat', dtype=meta['dtype'], mode='r',
+            shape=(n_blocks, self.n_channels, 2, self.block_frames)) \
+            if n_blocks else np.zeros((0, self.n_channels, 2, self.block_frames))
+
+
+    def frameRange(self, t0=None, t1=None):
+        """Frame numbers (start, stop) with PTP time t0 <= t < t1.
+        Frames are in arrival order, which is taken to be time order:
+        packets that arrived out of order can fall just either side
+        of the bounds.
+        """
+
+        t = self.frames['t']
+        start = 0 if t0 is None else int(np.searchsorted(t, t0, side='left'))
+        stop  = self.n_frames if t1 is None else int(np.searchsorted(t, t1, side='left'))
+
+        return start, max(start, stop)
+
+
+    def readChannel(self, channel, t0=None, t1=None):
+        """One channel over a time range.
+
+        channel: (int) Channel (KID) number.
+        t0, t1:  (int) PTP time bounds in nanoseconds (None for open ended).
+
+        Return: t (int64 ns), I and Q (int32) of that channel.
+        """
+
+        start, stop = self.frameRange(t0, t1)
+
+        # blocks holding the frames (a flush() can leave a block part full)
+        first, n = self.index['first'], self.index['n']
+        b0 = int(np.searchsorted(first + n, start, side='right'))
+        b1 = int(np.searchsorted(first, stop, side='left'))
+
+        seg = self.iq[b0:b1, channel] # (blocks, 2, B), only these bytes are read
+        filled = np.arange(self.block_frames) < n[b0:b1, None] # (blocks, B)
+        seg = seg.transpose(1, 0, 2)[:, filled] # (2, frames in the blocks)
+        if b1 > b0:
+            seg = seg[:, start - first[b0]:stop - first[b0]]
+
+        return np.array(self.frames['t'][start:stop]), seg[0], seg[1]
+
+
+
+# ============================================================================ #
+# TimeStreamRecorder
+# ============================================================================ #
+
+
+class TimeStreamRecorder:
+    """Background thread feeding a running timestream into a writer.
+
+    The timestream must be capturing in the background
+    (TimeStream.startCapture()) or be a SharedTimeStream,
+    and the writer is e.g. a TimeStreamWriter or TimeStreamArchiveWriter.
+    """
+
+    def __init__(self, timestream, writer, interval=0.1):
+        """
+        timestream: (TimeStream or SharedTimeStream) Packet source.
+        writer:     (TimeStreamWriter) Packet sink, with write(packets)
+            and close().
+        interval:   (float) Seconds between polls of the timestream.
+        """
+
+        self.timestream = timestream
+        self.writer     = writer
+        self.interval   = interval
+        self.skipped    = 0 # packets overwritten in the ring before written
+
+        self._stop = threading.Event()
+        self._thread = None
+
+
+    def start(self):
+        """Record packets from now on."""
+
+        self._cursor, _ = self.timestream.getRawSince(None)
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._loop, name='timestream_recorder', daemon=True)
+        self._thread.start()
+
+
+    def stop(self):
+        """Stop recording and close the writer."""
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.writer.close()
+
+
+    def _loop(self):
+        while True:
+            stopping = self._stop.wait(self.interval)
+
+            start = self._cursor
+            self._cursor, packets = self.timestream.getRawSince(start)
+            self.skipped += (self._cursor - start) - len(packets)
+            if len(packets):
+                self.writer.write(packets)
+
+            if stopping:
+                break
+
+
+
+# ============================================================================ #
+# loadTimestreamFiles
+def loadTimestreamFiles(dname, fname='timestream'):
+    """Memory map the timestream files written by TimeStreamWriter.
+
+    dname: (str) Directory the files are in.
+    fname: (str) Base filename, optionally with the timestamp,
+        e.g. 'timestream_20240101T000000Z' for a single capture.
+
+    Return: (list of 1D structured arrays) FRAME_DTYPE memmaps in file order.
+    """
+
+    paths = sorted(glob.glob(os.path.join(dname, f'{fname}_*.npy')))
+
+    return [np.load(path, mmap_mode='r') for path in paths]
+
+
+
+# ============================================================================ #
+# INTERNAL FUNCTIONS
+# ============================================================================ #
+
+
+# ============================================================================ #
+# _NpyAppender
+class _NpyAppender:
+    """A 1D .npy file of records which only grows at the end.
+    The header's length is rewritten after each append, so the file
+    is always a valid .npy of what has been written so far.
+    """
+
+    def __init__(self, path, dtype):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.n = 0
+
+        self._header_len = _npyHeaderLen(self.dtype)
+        self._f = open(path, 'wb')
+        self._f.write(_npyHeader(self.dtype, 0, self._header_len))
+
+
+    def append(self, records):
+        records = np.ascontiguousarray(records, dtype=self.dtype)
+        self._f.write(records.view(np.uint8)) # no copy
+        self.n += len(records)
+
+        self._f.seek(0)
+        self._f.write(_npyHeader(self.dtype, self.n, self._header_len))
+        self._f.seek(0, os.SEEK_END)
+        self._f.flush()
+
+
+    def close(self):
+        self._f.close()
+
+
+# ============================================================================ #
+# _npyHeader
+def _npyHeader(dtype, n, length):
+    """A version 1.0 .npy header for n records of dtype,
+    space padded to length bytes so it can be rewritten in place.
+    """
+
+    d = {'descr': np.lib.format.dtype_to_descr(dtype),
+         'fortran_order': False,
+         'shape': (int(n),)}
+    body = repr(d).encode('latin1')
+    prefix = np.lib.format.magic(1, 0) + struct.pack('<H', length - 10)
+
+    return prefix + body + b' '*(length - 10 - len(body) - 1) + b'\n'
+
+
+# ============================================================================ #
+# _npyHeaderLen
+def _npyHeaderLen(dtype):
+    """Header length (multiple of 64) with room for any frame count."""
+
+    d = {'descr': np.lib.format.dtype_to_descr(dtype),
+         'fortran_order': False,
+         'shape': (2**63,)}
+
+    return -(-(10 + len(repr(d)) + 1) // 64) * 64